@@ -25,7 +25,7 @@ def main():
     share_parser.add_argument('file_path', type=str, help="The path to the file you want to share")
     
     download_parser = subparsers.add_parser('download', help="Download a file from the network")
-    download_parser.add_argument('file_hash', type=str, help="The SHA-256 hash of the file to download")
+    download_parser.add_argument('file_hash', type=str, help="The file hash to download (shown when the file is shared)")
     
     daemon_parser = subparsers.add_parser('daemon', help="Run as a daemon to seed files")
 
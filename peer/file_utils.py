@@ -1,29 +1,134 @@
 import os
 import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 from tqdm import tqdm
 
+from peer import network_utils
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 
 logger = logging.getLogger(__name__)
 
-def get_file_hash(file_path: str) -> Optional[str]:
-    """Calculates the SHA-256 hash of an entire file."""
+# Digest used for file and chunk hashes. SHA-256 is what every peer
+# understands; BLAKE3 is opt-in (peer.hash_algorithm in config.yaml) and
+# needs the blake3 package on both the seeder and the downloader.
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+# Read size used when streaming whole files through the hasher. hashlib's
+# SHA-256 is backed by OpenSSL, which already dispatches to SHA-NI where the
+# CPU supports it; large reads keep the Python loop out of the way.
+HASH_BLOCK_SIZE = 1 << 20
+
+def is_hash_supported(algorithm: str) -> bool:
+    """Returns True if this install can compute the given hash algorithm."""
+    if algorithm == "sha256":
+        return True
+    if algorithm == "blake3":
+        return blake3 is not None
+    return False
+
+def new_hasher(algorithm: str = DEFAULT_HASH_ALGORITHM, data: bytes = b""):
+    """Returns a hashlib-style hasher for the given algorithm name."""
+    if algorithm == "sha256":
+        return hashlib.sha256(data)
+    if algorithm == "blake3" and blake3 is not None:
+        return blake3.blake3(data)
+    raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+
+def _advise_sequential(fd: int) -> None:
+    """Asks the kernel for aggressive readahead on a file read front to back."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+def merkle_root(chunk_hashes: List[str], algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    """
+    Computes the file hash: the root of a binary hash tree over the chunk
+    hashes. Leaves and inner nodes are domain-separated (0x00 / 0x01
+    prefixes, as in RFC 6962) and an odd node at the end of a level is
+    promoted unchanged. An empty file hashes to the digest of b"".
+    """
+    if not chunk_hashes:
+        return new_hasher(algorithm).hexdigest()
+    level = [new_hasher(algorithm, b"\x00" + bytes.fromhex(h)).digest() for h in chunk_hashes]
+    while len(level) > 1:
+        parents = [
+            new_hasher(algorithm, b"\x01" + level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0].hex()
+
+def get_file_hash(file_path: str, chunk_size: Optional[int] = None,
+                  algorithm: str = DEFAULT_HASH_ALGORITHM, drop_cache: bool = False) -> Optional[str]:
+    """
+    Calculates the hash of an entire file (the Merkle root of its chunk
+    hashes for the given chunk size, by default the configured
+    peer.chunk_size). With drop_cache, pages are released
+    from the page cache as soon as they are hashed, so a one-off pass over
+    a large file does not evict data the peer is actively serving.
+    """
     if not os.path.exists(file_path):
         logger.warning(f"File not found, cannot calculate hash: {file_path}")
         return None
+    if chunk_size is None:
+        chunk_size = network_utils.net_settings().chunk_size
         
-    sha256_hash = hashlib.sha256()
+    chunk_hashes = []
+    hasher = new_hasher(algorithm)
+    filled = 0
+    buf = bytearray(min(HASH_BLOCK_SIZE, chunk_size))
+    mv = memoryview(buf)
     try:
         with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+            _advise_sequential(f.fileno())
+            drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+            offset = 0
+            while True:
+                n = f.readinto(mv[:min(len(buf), chunk_size - filled)])
+                if not n:
+                    break
+                hasher.update(mv[:n])
+                if drop_cache:
+                    os.posix_fadvise(f.fileno(), offset, n, os.POSIX_FADV_DONTNEED)
+                offset += n
+                filled += n
+                if filled == chunk_size:
+                    chunk_hashes.append(hasher.hexdigest())
+                    hasher = new_hasher(algorithm)
+                    filled = 0
+        if filled:
+            chunk_hashes.append(hasher.hexdigest())
+        return merkle_root(chunk_hashes, algorithm)
     except IOError as e:
         logger.error(f"Error reading file {file_path} for hashing: {e}")
         return None
 
-def get_file_metadata(file_path: str, chunk_size: int) -> Optional[Dict[str, any]]:
+def _hash_chunks(fd: int, total: int, chunk_size: int, pbar: tqdm, algorithm: str) -> List[str]:
+    """
+    Hashes every chunk of an open file on a thread pool. os.pread and
+    hashlib both release the GIL, so chunks are read and hashed in
+    parallel. A file truncated meanwhile only yields short reads.
+    Returns the chunk hashes in order.
+    """
+    offsets = range(0, total, chunk_size)
+    chunk_hashes = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        digests = pool.map(lambda o: new_hasher(algorithm, os.pread(fd, chunk_size, o)).hexdigest(), offsets)
+        for offset, chunk_hash in zip(offsets, digests):
+            chunk_hashes.append(chunk_hash)
+            pbar.update(min(chunk_size, total - offset))
+    return chunk_hashes
+
+def get_file_metadata(file_path: str, chunk_size: int,
+                      algorithm: str = DEFAULT_HASH_ALGORITHM) -> Optional[Dict[str, any]]:
     """
     Reads a file and generates all metadata (main hash, chunk hashes)
     without writing any new files.
@@ -35,13 +140,7 @@ def get_file_metadata(file_path: str, chunk_size: int) -> Optional[Dict[str, any
     try:
         file_size = os.path.getsize(file_path)
         file_name = os.path.basename(file_path)
-        file_hash = get_file_hash(file_path) 
-        
-        if file_hash is None:
-            return None 
-
         chunk_hashes = []
-        chunk_count = 0
         
         with open(file_path, 'rb') as f:
             with tqdm(
@@ -51,15 +150,12 @@ def get_file_metadata(file_path: str, chunk_size: int) -> Optional[Dict[str, any
                 unit_scale=True, 
                 unit_divisor=1024
             ) as pbar:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    
-                    chunk_hash = hashlib.sha256(chunk).hexdigest()
-                    chunk_hashes.append(chunk_hash)
-                    chunk_count += 1
-                    pbar.update(len(chunk))
+                if file_size > 0:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    chunk_hashes = _hash_chunks(f.fileno(), file_size, chunk_size, pbar, algorithm)
+        chunk_count = len(chunk_hashes)
+        file_hash = merkle_root(chunk_hashes, algorithm)
         
         logger.info(f"Analyzed {file_name}. {chunk_count} chunks.")
         
@@ -67,13 +163,25 @@ def get_file_metadata(file_path: str, chunk_size: int) -> Optional[Dict[str, any
             "name": file_name,
             "size": file_size,
             "hash": file_hash,
+            "chunk_size": chunk_size,
             "chunk_count": chunk_count,
-            "chunk_hashes": chunk_hashes
+            "chunk_hashes": chunk_hashes,
+            "hash_algorithm": algorithm
         }
     except IOError as e:
         logger.error(f"Error reading file {file_path} for metadata: {e}")
         return None
 
+def open_for_chunk_reads(file_path: str) -> int:
+    """
+    Opens a shared file for repeated chunk reads and returns the raw fd.
+    Chunks are requested in no particular order, so readahead is disabled.
+    """
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+    return fd
+
 def read_chunk_from_file(file_path: str, chunk_index: int, chunk_size: int) -> Optional[bytes]:
     """
     Reads a specific chunk from a file using seek.
@@ -90,47 +198,27 @@ def read_chunk_from_file(file_path: str, chunk_index: int, chunk_size: int) -> O
         logger.error(f"Unexpected error in read_chunk_from_file: {e}")
         return None
 
-def reassemble_file(file_hash: str, chunk_count: int, chunks_dir: str, output_path: str) -> bool:
+def verify_chunk_data(chunk_data: bytes, expected_digest: bytes,
+                      algorithm: str = DEFAULT_HASH_ALGORITHM) -> bool:
     """
-    Reassembles a file from its chunks.
+    Verifies the integrity of a single chunk's raw data against its raw
+    digest. Hex chunk hashes are converted once, when the file's metadata
+    arrives, rather than hex-encoding every received chunk's digest.
     """
     try:
-        with open(output_path, 'wb') as output_file:
-            for i in tqdm(range(chunk_count), desc=f"Reassembling {os.path.basename(output_path)}", unit="chunk"):
-                chunk_filename = f"{file_hash}.{i}"
-                chunk_path = os.path.join(chunks_dir, chunk_filename)
-                
-                if not os.path.exists(chunk_path):
-                    logger.error(f"Missing chunk {i} ({chunk_path}) for file {file_hash}")
-                    return False
-                
-                with open(chunk_path, 'rb') as chunk_file:
-                    output_file.write(chunk_file.read())
-        
-        logger.info(f"Successfully reassembled file {file_hash} to {output_path}")
-        return True
-    except IOError as e:
-        logger.error(f"Error reassembling file {file_hash}: {e}")
-        return False
-    except Exception as e:
-        logger.error(f"An unexpected error occurred in reassemble_file: {e}")
-        return False
-
-def verify_chunk_data(chunk_data: bytes, expected_hash: str) -> bool:
-    """Verifies the integrity of a single chunk's raw data."""
-    try:
-        actual_hash = hashlib.sha256(chunk_data).hexdigest()
-        is_valid = actual_hash == expected_hash
+        actual_digest = new_hasher(algorithm, chunk_data).digest()
+        is_valid = actual_digest == expected_digest
         if not is_valid:
-            logger.warning(f"Chunk integrity check FAILED. Expected {expected_hash}, got {actual_hash}")
+            logger.warning(f"Chunk integrity check FAILED. Expected {expected_digest.hex()}, got {actual_digest.hex()}")
         return is_valid
     except Exception as e:
         logger.error(f"Error verifying chunk data: {e}")
         return False
 
-def verify_file_integrity(file_path: str, expected_hash: str) -> bool:
+def verify_file_integrity(file_path: str, expected_hash: str, chunk_size: Optional[int] = None,
+                          algorithm: str = DEFAULT_HASH_ALGORITHM) -> bool:
     """Verifies the integrity of a fully reassembled file."""
-    actual_hash = get_file_hash(file_path)
+    actual_hash = get_file_hash(file_path, chunk_size, algorithm, drop_cache=True)
     if actual_hash is None:
         return False 
         
@@ -141,7 +229,8 @@ def verify_file_integrity(file_path: str, expected_hash: str) -> bool:
         logger.info(f"File integrity check SUCCESS for {file_path}")
     return is_valid
 
-def split_file(file_path: str, chunk_size: int, output_dir: str) -> Optional[Dict[str, any]]:
+def split_file(file_path: str, chunk_size: int, output_dir: str,
+               algorithm: str = DEFAULT_HASH_ALGORITHM) -> Optional[Dict[str, any]]:
     """
     Splits a file into chunks and saves them to a directory.
     (This is the old, deprecated function. Use get_file_metadata for sharing)
@@ -154,13 +243,12 @@ def split_file(file_path: str, chunk_size: int, output_dir: str) -> Optional[Dic
     try:
         file_size = os.path.getsize(file_path)
         file_name = os.path.basename(file_path)
-        file_hash = get_file_hash(file_path)
-        
-        if file_hash is None:
-            return None 
 
         os.makedirs(output_dir, exist_ok=True)
         
+        # Chunk files are named after the file hash, which is only known
+        # once every chunk has been hashed, so write them under their index
+        # first and rename afterwards.
         chunk_hashes = []
         chunk_count = 0
         with open(file_path, 'rb') as f:
@@ -169,16 +257,20 @@ def split_file(file_path: str, chunk_size: int, output_dir: str) -> Optional[Dic
                 if not chunk:
                     break
                 
-                chunk_hash = hashlib.sha256(chunk).hexdigest()
+                chunk_hash = new_hasher(algorithm, chunk).hexdigest()
                 chunk_hashes.append(chunk_hash)
                 
-                chunk_filename = f"{file_hash}.{chunk_count}"
-                chunk_path = os.path.join(output_dir, chunk_filename)
+                chunk_path = os.path.join(output_dir, f".split.{chunk_count}")
                 
                 with open(chunk_path, 'wb') as chunk_file:
                     chunk_file.write(chunk)
                 
                 chunk_count += 1
+
+        file_hash = merkle_root(chunk_hashes, algorithm)
+        for i in range(chunk_count):
+            os.replace(os.path.join(output_dir, f".split.{i}"),
+                       os.path.join(output_dir, f"{file_hash}.{i}"))
         
         logger.info(f"Split {file_name} into {chunk_count} chunks in {output_dir}")
         
@@ -187,7 +279,8 @@ def split_file(file_path: str, chunk_size: int, output_dir: str) -> Optional[Dic
             "size": file_size,
             "hash": file_hash,
             "chunk_count": chunk_count,
-            "chunk_hashes": chunk_hashes
+            "chunk_hashes": chunk_hashes,
+            "hash_algorithm": algorithm
         }
     except IOError as e:
         logger.error(f"Error splitting file {file_path}: {e}")
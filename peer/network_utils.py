@@ -1,39 +1,206 @@
 import socket
+import struct
+import functools
+import queue
+import threading
+import time
+import selectors
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import yaml
 import os
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, Optional, Tuple, List, NamedTuple, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# LibYAML's C parser when PyYAML was built with it.
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 # --- Configuration ---
 logger = logging.getLogger(__name__)
 CONFIG_FILE = 'config.yaml'
 
+# orjson encodes straight to bytes and parses bytes without a separate
+# UTF-8 decode; the stdlib json module is the fallback.
+if orjson:
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+else:
+    # Same compact UTF-8 output orjson produces.
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    _loads = json.loads
+
+# Every control message is a 4-byte big-endian length followed by that
+# many bytes of JSON, so a receiver reads exactly what it needs.
+_LENGTH = struct.Struct('!I')
+# Chunk requests are fixed-size binary too: an opcode, the 32-byte file
+# digest and the chunk index.
+_CHUNK_REQ = struct.Struct('!B32sI')
+OP_REQUEST_CHUNK = 1
+# Chunk responses carry a fixed binary header instead of JSON: a status
+# byte and the length of what follows (chunk bytes on success, a UTF-8
+# error message otherwise).
+_CHUNK_HDR = struct.Struct('!BI')
+CHUNK_OK = 0
+CHUNK_ERROR = 1
+# Upper bound on a control message body; guards against allocating
+# whatever a corrupt or hostile length prefix asks for.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+@functools.lru_cache(maxsize=1)
 def load_config():
+    """
+    Parses config.yaml once per process; every later call returns the same
+    dict, so callers must treat it as read-only.
+    """
     with open(CONFIG_FILE, 'r') as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=_YAML_LOADER)
+
+class NetSettings(NamedTuple):
+    buffer_size: int
+    chunk_size: int
+    so_rcvbuf: int
+    so_sndbuf: int
+
+@functools.lru_cache(maxsize=1)
+def net_settings() -> NetSettings:
+    """The config values the per-message paths need, resolved once."""
+    config = load_config()
+    peer_cfg = config.get('peer', {})
+    return NetSettings(
+        buffer_size=config['tracker']['buffer_size'],
+        chunk_size=peer_cfg['chunk_size'],
+        so_rcvbuf=peer_cfg.get('so_rcvbuf') or 0,
+        so_sndbuf=peer_cfg.get('so_sndbuf') or 0,
+    )
+
+def apply_socket_buffers(sock: socket.socket):
+    """
+    Applies peer.so_rcvbuf / peer.so_sndbuf when set. On a listening socket
+    call it before listen(), so accepted connections start with the larger
+    receive window.
+    """
+    settings = net_settings()
+    if settings.so_rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, settings.so_rcvbuf)
+    if settings.so_sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, settings.so_sndbuf)
+
+def _tune_socket(sock: socket.socket):
+    """
+    Disables Nagle so small control frames go out immediately, and applies
+    the configured socket buffers. Call before connect() so the receive
+    window is negotiated with the larger buffer.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    apply_socket_buffers(sock)
+
+# Probe an idle tracker connection after 30 s, every 10 s, and drop it after
+# 3 unanswered probes, so a NAT that forgot the mapping is noticed in about
+# a minute instead of the kernel's two-hour default.
+TRACKER_KEEPALIVE = (30, 10, 3)
+
+def _enable_keepalive(sock: socket.socket):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    idle, interval, count = TRACKER_KEEPALIVE
+    # The per-socket knobs are Linux-only (macOS names the first TCP_KEEPALIVE).
+    for opt, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+def _send_framed(sock: socket.socket, payload: bytes):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+def _send_chunk_file(sock: socket.socket, fileobj, offset: int, count: int) -> None:
+    """
+    Sends a success chunk header followed by count bytes of fileobj from
+    offset. The body goes through socket.sendfile (sendfile(2) on Linux),
+    so chunk data never passes through user space; MSG_MORE lets the
+    kernel put the header in the same segment as the first payload bytes.
+    """
+    sock.sendall(_CHUNK_HDR.pack(CHUNK_OK, count), getattr(socket, 'MSG_MORE', 0))
+    sent = sock.sendfile(fileobj, offset, count)
+    if sent != count:
+        # The file shrank under us; the stream is now out of sync.
+        raise ConnectionError(f"sent {sent} of {count} bytes")
+
+def _send_chunk_error(sock: socket.socket, message: str) -> None:
+    body = message.encode('utf-8')
+    sock.sendall(_CHUNK_HDR.pack(CHUNK_ERROR, len(body)) + body)
+
+# Asks the kernel to fill the whole request in one call. Sockets with a
+# timeout are non-blocking underneath and may still return short reads,
+# so the loop below stays.
+_WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+
+def _recv_into(sock: socket.socket, mv: memoryview, buffer_size: int) -> bool:
+    """Fills mv completely, buffer_size at most per recv. False on EOF."""
+    n = len(mv)
+    received = 0
+    while received < n:
+        want = min(buffer_size, n - received)
+        got = sock.recv_into(mv[received:received + want], want, _WAITALL)
+        if not got: return False
+        received += got
+    return True
+
+def _recv_exact(sock: socket.socket, n: int, buffer_size: int) -> Optional[bytearray]:
+    """Reads exactly n bytes, buffer_size at most per recv. None on EOF."""
+    buf = bytearray(n)
+    return buf if _recv_into(sock, memoryview(buf), buffer_size) else None
+
+class BufferPool:
+    """
+    Freelist of fixed-size bytearrays so concurrent chunk transfers reuse
+    buffers instead of allocating a fresh chunk-sized one per request.
+    """
+    def __init__(self, size: int, capacity: int):
+        self.size = size
+        self._free = queue.LifoQueue(capacity)
+
+    def acquire(self) -> bytearray:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return bytearray(self.size)
+
+    def release(self, buf: bytearray):
+        if len(buf) != self.size: return
+        try:
+            self._free.put_nowait(buf)
+        except queue.Full:
+            pass
+
+@functools.lru_cache(maxsize=1)
+def chunk_buffer_pool() -> BufferPool:
+    """Process-wide pool of chunk_size buffers for downloads."""
+    return BufferPool(net_settings().chunk_size, capacity=8)
 
 def send_message(sock: socket.socket, message: Dict[str, Any]):
     try:
-        sock.sendall(json.dumps(message).encode('utf-8'))
+        _send_framed(sock, _dumps(message))
     except socket.error as e:
         logger.error(f"Failed to send: {e}")
         raise
 
 def receive_json_message(sock: socket.socket, buffer_size: int) -> Optional[Dict[str, Any]]:
-    buffer = b""
-    json_decoder = json.JSONDecoder()
-    while True:
-        try:
-            message, index = json_decoder.raw_decode(buffer.decode('utf-8'))
-            return message
-        except json.JSONDecodeError:
-            try:
-                data = sock.recv(buffer_size)
-                if not data: return None
-                buffer += data
-            except Exception: return None
-        except Exception: return None
+    try:
+        prefix = _recv_exact(sock, _LENGTH.size, buffer_size)
+        if prefix is None: return None
+        (length,) = _LENGTH.unpack(prefix)
+        if length > MAX_MESSAGE_SIZE:
+            logger.warning(f"Refusing {length}-byte message (limit {MAX_MESSAGE_SIZE})")
+            return None
+        body = _recv_exact(sock, length, buffer_size)
+        if body is None: return None
+        return _loads(body)
+    except (OSError, ValueError):
+        return None
 
 # --- Tracker Communication ---
 
@@ -41,6 +208,8 @@ def connect_to_tracker() -> Optional[socket.socket]:
     try:
         config = load_config()
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _tune_socket(sock)
+        _enable_keepalive(sock)
         sock.connect((config['tracker']['host'], config['tracker']['port']))
         sock.settimeout(10.0)
         return sock
@@ -48,87 +217,318 @@ def connect_to_tracker() -> Optional[socket.socket]:
         logger.error(f"Tracker connection failed: {e}")
         return None
 
+# Envelopes are fixed, so only the payload is serialized per call.
+_REGISTER_TMPL = b'{"command":"register","payload":%s}'
+_QUERY_FILE_TMPL = b'{"command":"query_file","payload":%s}'
+_SEARCH_TMPL = b'{"command":"search","payload":%s}'
+
+def _tracker_request(sock: socket.socket, template: bytes, payload: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        _send_framed(sock, template % _dumps(payload))
+    except socket.error as e:
+        logger.error(f"Failed to send: {e}")
+        raise
+    return receive_json_message(sock, net_settings().buffer_size) or {}
+
 def register_with_tracker(sock: socket.socket, peer_id: str, peer_port: int, files: list) -> Dict[str, Any]:
-    msg = {"command": "register", "payload": {"peer_id": peer_id, "port": peer_port, "files": files}}
-    send_message(sock, msg)
-    return receive_json_message(sock, load_config()['tracker']['buffer_size']) or {}
+    return _tracker_request(sock, _REGISTER_TMPL, {"peer_id": peer_id, "port": peer_port, "files": files})
 
 def query_tracker_for_file(sock: socket.socket, file_hash: str) -> Dict[str, Any]:
-    msg = {"command": "query_file", "payload": {"file_hash": file_hash}}
-    send_message(sock, msg)
-    return receive_json_message(sock, load_config()['tracker']['buffer_size']) or {}
+    return _tracker_request(sock, _QUERY_FILE_TMPL, {"file_hash": file_hash})
 
 # --- NEW SEARCH FUNCTION ---
 def search_tracker(sock: socket.socket, query: str) -> Dict[str, Any]:
-    msg = {"command": "search", "payload": {"query": query}}
-    send_message(sock, msg)
-    return receive_json_message(sock, load_config()['tracker']['buffer_size']) or {}
+    return _tracker_request(sock, _SEARCH_TMPL, {"query": query})
 
 # --- Peer Communication ---
 
-def request_chunk_from_peer(peer_addr: Tuple[str, int], file_hash: str, chunk_index: int) -> Optional[bytes]:
-    logger.debug(f"Requesting chunk {chunk_index} from {peer_addr}")
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+# A peer server drops a keep-alive connection after this many idle seconds;
+# clients stop reusing pooled connections well before that.
+PEER_IDLE_TIMEOUT = 60.0
+POOL_IDLE_TIMEOUT = PEER_IDLE_TIMEOUT / 2
+
+class PeerConnectionPool:
+    """
+    Idle keep-alive connections to other peers' servers, keyed by address,
+    so consecutive chunk requests skip the TCP handshake and slow start.
+    A checked-out connection belongs to one thread until it is released.
+    """
+    def __init__(self, idle_timeout: float = POOL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._idle: Dict[Tuple[str, int], List[Tuple[socket.socket, float]]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, addr: Tuple[str, int]) -> Tuple[socket.socket, bool]:
+        """Returns (sock, reused). Raises OSError if a new connection fails."""
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(addr)
+            while idle:
+                sock, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    return sock, True
+                sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
             sock.settimeout(15.0)
-            sock.connect(peer_addr)
-            
-            send_message(sock, {
-                "command": "request_chunk", 
-                "payload": {"file_hash": file_hash, "chunk_index": chunk_index}
-            })
-            
-            buffer = b""
-            raw_data_buffer = b""
-            while True:
-                end_idx = buffer.find(b'}')
-                if end_idx != -1:
-                    header_bytes = buffer[:end_idx + 1]
-                    raw_data_buffer = buffer[end_idx + 1:]
-                    try:
-                        header = json.loads(header_bytes.decode('utf-8'))
-                        break
-                    except: pass
-                data = sock.recv(128)
-                if not data: return None
-                buffer += data
-            
-            if header.get('status') != 'success': return None
-            
-            chunk_data = raw_data_buffer
-            received = len(chunk_data)
-            total = header.get('chunk_size', 0)
-            cfg_buf = load_config()['tracker']['buffer_size']
-            
-            while received < total:
-                data = sock.recv(min(cfg_buf, total - received))
-                if not data: return None
-                chunk_data += data
-                received += len(data)
-            
-            return chunk_data
-    except Exception:
+            _tune_socket(sock)
+            sock.connect(addr)
+        except OSError:
+            sock.close()
+            raise
+        return sock, False
+
+    def release(self, addr: Tuple[str, int], sock: socket.socket):
+        with self._lock:
+            self._idle.setdefault(addr, []).append((sock, time.monotonic()))
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for sock, _ in idle:
+                    sock.close()
+            self._idle.clear()
+
+PEER_CONNECTIONS = PeerConnectionPool()
+
+def _read_chunk_response(sock: socket.socket, buffer: Optional[bytearray], buffer_size: int):
+    """
+    Reads one chunk response. Returns the chunk, or None if the peer
+    answered that it does not have it. Raises ConnectionError when the
+    connection can no longer be used.
+    """
+    header = _recv_exact(sock, _CHUNK_HDR.size, buffer_size)
+    if header is None: raise ConnectionError("no response header")
+    status, total = _CHUNK_HDR.unpack(header)
+    if total > MAX_MESSAGE_SIZE: raise ConnectionError(f"chunk_size {total} too large")
+    if status != CHUNK_OK:
+        # Consume the error text so the connection stays usable.
+        if _recv_exact(sock, total, buffer_size) is None: raise ConnectionError("truncated error")
         return None
+    # Filled in place with recv_into; no per-recv bytes objects. Each recv
+    # may take everything the socket has queued rather than buffer_size.
+    if buffer is None or total > len(buffer):
+        data = _recv_exact(sock, total, total)
+        if data is None: raise ConnectionError("truncated chunk")
+        return data
+    view = memoryview(buffer)[:total]
+    if not _recv_into(sock, view, total): raise ConnectionError("truncated chunk")
+    return view
 
-def handle_peer_request(conn: socket.socket, addr: Tuple[str, int], storage_manager):
-    logger.info(f"Connection from {addr}")
+def request_chunks_from_peer(peer_addr: Tuple[str, int], file_hash: str, chunk_indices: List[int],
+                             on_chunk: Callable[[int, Any], None],
+                             buffer: Optional[bytearray] = None,
+                             on_missing: Optional[Callable[[int], None]] = None) -> List[int]:
+    """
+    Pipelines requests for several chunks of one file over a pooled
+    keep-alive connection: every request is written before the first
+    response is read, so the seeder streams the chunks back to back
+    instead of waiting a round trip for each. on_chunk(index, data) is
+    called in request order for every chunk the peer sends. With a buffer
+    each body is received into it and data is a memoryview of the filled
+    prefix; without one data is a new bytearray. Either way it is only
+    valid during the call. on_missing(index), if given, is called in the
+    same order for every chunk the peer refuses. Returns the indices that
+    were not delivered.
+    """
+    logger.debug(f"Requesting chunks {chunk_indices} from {peer_addr}")
     try:
-        config = load_config()
-        msg = receive_json_message(conn, config['tracker']['buffer_size'])
-        if not msg: return
-
-        if msg.get('command') == 'request_chunk':
-            p = msg.get('payload', {})
-            data = storage_manager.get_chunk_data_for_upload(
-                p.get('file_hash'), p.get('chunk_index'), config['peer']['chunk_size']
-            )
-            if data:
-                send_message(conn, {"status": "success", "chunk_size": len(data)})
-                conn.sendall(data)
-                logger.info(f"Sent chunk {p.get('chunk_index')} to {addr}")
-            else:
-                send_message(conn, {"status": "error", "message": "Not found"})
-    except Exception as e:
-        logger.error(f"Handler error: {e}")
-    finally:
-        conn.close()
\ No newline at end of file
+        digest = bytes.fromhex(file_hash)
+    except ValueError:
+        return list(chunk_indices)
+    if len(digest) != 32: return list(chunk_indices)
+    addr = tuple(peer_addr)
+    cfg_buf = net_settings().buffer_size
+    remaining = list(chunk_indices)
+    missing: List[int] = []
+    while remaining:
+        try:
+            sock, reused = PEER_CONNECTIONS.acquire(addr)
+        except OSError:
+            break
+        try:
+            sock.sendall(b''.join(_CHUNK_REQ.pack(OP_REQUEST_CHUNK, digest, i) for i in remaining))
+            while remaining:
+                data = _read_chunk_response(sock, buffer, cfg_buf)
+                idx = remaining.pop(0)
+                if data is None:
+                    missing.append(idx)
+                    if on_missing: on_missing(idx)
+                else:
+                    on_chunk(idx, data)
+        except (OSError, ValueError):
+            sock.close()
+            # The peer may have closed an idle pooled connection; if nothing
+            # was answered yet, retry on a fresh one before giving up.
+            if reused and len(remaining) == len(chunk_indices): continue
+            break
+        except Exception:
+            sock.close()
+            raise
+        PEER_CONNECTIONS.release(addr, sock)
+    return missing + remaining
+
+def serve_chunk_request(conn: socket.socket, addr: Tuple[str, int], storage_manager) -> bool:
+    """
+    Reads and answers one chunk request on conn. Returns False when the
+    connection should be closed (EOF, timeout or an unknown request).
+    """
+    settings = net_settings()
+    try:
+        req = _recv_exact(conn, _CHUNK_REQ.size, settings.buffer_size)
+    except OSError:
+        return False  # timeout or reset between requests
+    if req is None: return False
+    op, digest, chunk_index = _CHUNK_REQ.unpack(req)
+    if op != OP_REQUEST_CHUNK:
+        # Unknown request lengths cannot be skipped; drop the connection.
+        _send_chunk_error(conn, "Unknown command")
+        return False
+
+    chunk = storage_manager.open_chunk(digest.hex(), chunk_index, settings.chunk_size)
+    if chunk:
+        f, offset, length = chunk
+        with f:
+            _send_chunk_file(conn, f, offset, length)
+        logger.info(f"Sent chunk {chunk_index} to {addr}")
+    else:
+        _send_chunk_error(conn, "Not found")
+    return True
+
+class PeerServer:
+    """
+    Accepts peer connections and serves their chunk requests. Idle
+    keep-alive connections wait in a selector instead of holding a thread
+    each; a readable connection is handed to a bounded worker pool for one
+    request and then returned to the selector.
+    """
+    def __init__(self, storage_manager, max_workers: Optional[int] = None):
+        self.storage = storage_manager
+        if max_workers is None:
+            max_workers = min(32, 2 * (os.cpu_count() or 1))
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='peer-upload')
+        self._sel = selectors.DefaultSelector()
+        # Workers hand finished connections back through _returned and poke
+        # the selector awake through this socket pair.
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._returned: List[Tuple[socket.socket, Tuple[str, int]]] = []
+        self._lock = threading.Lock()
+        self._idle_since: Dict[socket.socket, float] = {}
+        self._running = True
+        self._started = False
+
+    def serve_forever(self, listen_sock: socket.socket):
+        with self._lock:
+            if not self._running: return
+            self._started = True
+        self._sel.register(listen_sock, selectors.EVENT_READ)
+        self._sel.register(self._wake_r, selectors.EVENT_READ)
+        try:
+            while self._running:
+                # Sleeps until a socket is ready or the oldest idle
+                # connection expires; close() wakes it through _wake_r.
+                for key, _ in self._sel.select(timeout=self._next_expiry()):
+                    if key.fileobj is listen_sock:
+                        self._accept(listen_sock)
+                    elif key.fileobj is self._wake_r:
+                        self._drain_wakeups()
+                    else:
+                        self._dispatch(key.fileobj, key.data)
+                self._readmit()
+                self._expire_idle()
+        finally:
+            self._shutdown()
+
+    def close(self):
+        with self._lock:
+            self._running = False
+            started = self._started
+        if started:
+            self._wake()
+        else:
+            self._shutdown()
+
+    def _accept(self, listen_sock: socket.socket):
+        try:
+            conn, addr = listen_sock.accept()
+        except OSError:
+            return
+        logger.info(f"Connection from {addr}")
+        try:
+            _tune_socket(conn)
+            # Only bounds a request that has started arriving; idleness
+            # between requests is handled by _expire_idle.
+            conn.settimeout(15.0)
+        except OSError:
+            conn.close()
+            return
+        self._park(conn, addr)
+
+    def _park(self, conn: socket.socket, addr: Tuple[str, int]):
+        self._sel.register(conn, selectors.EVENT_READ, addr)
+        self._idle_since[conn] = time.monotonic()
+
+    def _dispatch(self, conn: socket.socket, addr: Tuple[str, int]):
+        self._sel.unregister(conn)
+        del self._idle_since[conn]
+        self._pool.submit(self._serve, conn, addr)
+
+    def _serve(self, conn: socket.socket, addr: Tuple[str, int]):
+        try:
+            keep = serve_chunk_request(conn, addr, self.storage)
+        except Exception as e:
+            logger.error(f"Handler error: {e}")
+            keep = False
+        if not keep or not self._running:
+            conn.close()
+            return
+        with self._lock:
+            self._returned.append((conn, addr))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass  # already full (a wakeup is pending) or closed
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _readmit(self):
+        with self._lock:
+            returned, self._returned = self._returned, []
+        for conn, addr in returned:
+            self._park(conn, addr)
+
+    def _next_expiry(self) -> Optional[float]:
+        # _idle_since is in parking order, so the first entry expires first.
+        for since in self._idle_since.values():
+            return max(0.0, since + PEER_IDLE_TIMEOUT - time.monotonic())
+        return None
+
+    def _expire_idle(self):
+        cutoff = time.monotonic() - PEER_IDLE_TIMEOUT
+        expired = []
+        for conn, since in self._idle_since.items():
+            if since >= cutoff: break
+            expired.append(conn)
+        for conn in expired:
+            self._sel.unregister(conn)
+            del self._idle_since[conn]
+            conn.close()
+
+    def _shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        for conn in list(self._idle_since):
+            conn.close()
+        self._idle_since.clear()
+        self._sel.close()
+        self._wake_r.close()
+        self._wake_w.close()
@@ -4,10 +4,10 @@ import uuid
 import logging
 import time
 import os
-import yaml
 import queue
 import json
 import shutil
+import random
 from typing import Dict, Any, Optional, List, Tuple
 
 from peer.storage import StorageManager
@@ -16,7 +16,109 @@ from peer import file_utils
 from peer import network_utils
 
 logger = logging.getLogger(__name__)
-CONFIG_FILE = 'config.yaml'
+# Identity file path -> peer id, so repeated Peer() calls skip the read.
+_identity_cache: Dict[str, str] = {}
+# Default number of download workers; peer.download_workers overrides it.
+DOWNLOAD_WORKERS = 4
+# Chunk requests a download worker keeps in flight to one peer;
+# peer.pipeline_depth overrides it.
+PIPELINE_DEPTH = 4
+# A chunk in flight this long (seconds) is re-requested from another peer
+# by the next free worker; whichever copy verifies first is kept.
+HEDGE_AFTER = 2.0
+# Weight of the newest sample in each peer's download throughput average.
+BANDWIDTH_ALPHA = 0.3
+# Tracker connection attempts, with the delay (seconds) doubling from this.
+TRACKER_CONNECT_ATTEMPTS = 3
+TRACKER_RETRY_DELAY = 0.25
+
+class _InFlightChunks:
+    """
+    Chunks the download workers are currently fetching, from which peer
+    and by which worker. Lets free workers race a stalled peer for its
+    chunks, and signals download_file once every chunk is stored or
+    every worker has exited.
+    """
+    def __init__(self, needed: int, workers: int):
+        self.lock = threading.Lock()
+        self.chunks: Dict[int, Tuple[str, float, int]] = {}
+        self.hedged = set()
+        self.stored = set()
+        self.done = threading.Event()
+        self._needed = needed
+        self._workers = workers
+
+    def start(self, indices: List[int], pid: str):
+        """
+        Tracks a pipelined batch. The peer answers its chunks one after
+        another, so each gets HEDGE_AFTER of its own: the clock of the k-th
+        starts k windows after the requests were sent.
+        """
+        now, ident = time.monotonic(), threading.get_ident()
+        with self.lock:
+            for k, idx in enumerate(indices):
+                self.chunks[idx] = (pid, now + k * HEDGE_AFTER, ident)
+
+    def answered(self, indices: List[int], idx: int):
+        """
+        Stops tracking idx, and restarts the clocks of the chunks behind it
+        in its batch, which the peer only begins sending now.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.chunks.pop(idx, None)
+            if entry is None: return
+            pid, _, ident = entry
+            for k, later in enumerate(indices[indices.index(idx) + 1:]):
+                if later in self.chunks:
+                    self.chunks[later] = (pid, now + k * HEDGE_AFTER, ident)
+
+    def finish(self, indices: List[int]):
+        with self.lock:
+            for idx in indices: self.chunks.pop(idx, None)
+
+    def next_slow(self) -> Optional[Tuple[int, str]]:
+        """
+        Claims one unstored chunk from a batch whose current chunk has been
+        in flight for HEDGE_AFTER seconds; the chunks queued behind it on
+        that connection are stuck as well.
+        """
+        cutoff = time.monotonic() - HEDGE_AFTER
+        with self.lock:
+            stuck = {ident for _, since, ident in self.chunks.values() if since <= cutoff}
+            for idx, (pid, _, ident) in self.chunks.items():
+                if ident in stuck and idx not in self.hedged and idx not in self.stored:
+                    self.hedged.add(idx)
+                    return idx, pid
+        return None
+
+    def stalled(self) -> Tuple[set, int]:
+        """Peers with a request older than HEDGE_AFTER, and how many workers wait on them."""
+        cutoff = time.monotonic() - HEDGE_AFTER
+        with self.lock:
+            slow = [(pid, ident) for pid, since, ident in self.chunks.values() if since <= cutoff]
+        return {pid for pid, _ in slow}, len({ident for _, ident in slow})
+
+    def mark_stored(self, idx: int) -> bool:
+        """Records a stored chunk; True only for the first copy of it."""
+        with self.lock:
+            if idx in self.stored: return False
+            self.stored.add(idx)
+            if len(self.stored) >= self._needed: self.done.set()
+            return True
+
+    def busy(self) -> bool:
+        with self.lock:
+            return bool(self.chunks)
+
+    def add_worker(self):
+        with self.lock:
+            self._workers += 1
+
+    def worker_exited(self):
+        with self.lock:
+            self._workers -= 1
+            if self._workers == 0: self.done.set()
 
 class Peer:
     def __init__(self, instance_name: str = None):
@@ -31,71 +133,104 @@ class Peer:
         self.peer_id = self._load_or_create_identity()
         
         self.config = self._load_config()
+        self.pipeline_depth = max(1, self.config['peer'].get('pipeline_depth', PIPELINE_DEPTH))
         # Pass the instance_dir to storage manager so each peer has its own folder
         self.storage = StorageManager(self.peer_id, instance_dir=self.instance_dir)
         
         # Initialize Reputation Manager
         self.reputation = ReputationManager(self.peer_id)
         
-        self.server_port = self._get_free_port()
+        self.server_port = 0  # assigned by the OS in start_server()
         self.server_host = "127.0.0.1"
         self.server_thread = None
+        self.server = network_utils.PeerServer(self.storage, self.config['peer'].get('server_workers'))
         self.is_running = True
         self.tracker_sock = None
+        # peer_id -> moving average of observed download rate (bytes/s)
+        self.peer_bandwidth: Dict[str, float] = {}
+        self.peer_bandwidth_lock = threading.Lock()
         
         # WEB UI STATE
         self.active_downloads: Dict[str, Dict[str, Any]] = {} 
         self.download_history: List[Dict[str, Any]] = []
 
     def _load_or_create_identity(self) -> str:
+        path = os.path.abspath(self.identity_file)
+        peer_id = _identity_cache.get(path)
+        if peer_id is None:
+            peer_id = self._read_identity() or self._create_identity()
+            _identity_cache[path] = peer_id
+        return peer_id
+
+    def _read_identity(self) -> Optional[str]:
         if os.path.exists(self.identity_file):
             try:
                 with open(self.identity_file, 'r') as f:
                     data = json.load(f)
                     if 'peer_id' in data:
                         return data['peer_id']
-            except: pass
-        
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable identity file {self.identity_file}: {e}")
+        return None
+
+    def _create_identity(self) -> str:
         new_id = f"peer_{uuid.uuid4().hex[:8]}"
-        with open(self.identity_file, 'w') as f:
-            json.dump({'peer_id': new_id}, f)
+        data = json.dumps({'peer_id': new_id})
+        try:
+            # O_EXCL: if two peers start at once, the first writer's id wins.
+            fd = os.open(self.identity_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            existing = self._read_identity()
+            if existing: return existing
+            # Unreadable leftover; replace it.
+            with open(self.identity_file, 'w') as f:
+                f.write(data)
+            return new_id
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
         return new_id
 
     def _load_config(self) -> Dict[str, Any]:
         try:
-            with open(CONFIG_FILE, 'r') as f: return yaml.safe_load(f)
+            # Shared with network_utils: parsed once per process, read-only.
+            return network_utils.load_config()
         except:
             # Fallback config if file fails
-            return {'peer': {'chunk_size': 1048576}, 'tracker': {'host': '127.0.0.1', 'port': 9090, 'buffer_size': 4096}}
-
-    def _get_free_port(self) -> int:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', 0))
-            return s.getsockname()[1]
+            return {'peer': {'chunk_size': 1048576}, 'tracker': {'host': '127.0.0.1', 'port': 9090, 'buffer_size': 65536}}
 
     def start_server(self):
-        self.server_thread = threading.Thread(target=self._run_server, daemon=True)
+        # Bound here rather than in the server thread, so the OS-assigned
+        # port is known before callers register it with the tracker.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.server_host, self.server_port))
+            self.server_port = s.getsockname()[1]
+            network_utils.apply_socket_buffers(s)
+            s.listen(5)
+        except OSError as e:
+            s.close()
+            logger.error(f"Server error: {e}")
+            return
+        self.server_thread = threading.Thread(target=self._run_server, args=(s,), daemon=True)
         self.server_thread.start()
         logger.info(f"Peer server on port {self.server_port}")
 
-    def _run_server(self):
+    def _run_server(self, s: socket.socket):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind((self.server_host, self.server_port))
-                s.listen(5)
-                while self.is_running:
-                    try:
-                        s.settimeout(1.0)
-                        conn, addr = s.accept()
-                        threading.Thread(target=network_utils.handle_peer_request, 
-                                       args=(conn, addr, self.storage), daemon=True).start()
-                    except socket.timeout: continue
+            with s:
+                self.server.serve_forever(s)
         except Exception as e: logger.error(f"Server error: {e}")
 
     def start_tracker_connection(self):
         if self.tracker_sock: return
-        self.tracker_sock = network_utils.connect_to_tracker()
+        delay = TRACKER_RETRY_DELAY
+        for attempt in range(TRACKER_CONNECT_ATTEMPTS):
+            self.tracker_sock = network_utils.connect_to_tracker()
+            if self.tracker_sock or not self.is_running: return
+            if attempt + 1 < TRACKER_CONNECT_ATTEMPTS:
+                time.sleep(delay)
+                delay *= 2
 
     def register_with_tracker(self):
         if not self.tracker_sock: self.start_tracker_connection()
@@ -108,7 +243,11 @@ class Peer:
                 self.tracker_sock = None
 
     def share_file(self, file_path: str):
-        meta = self.storage.add_file_to_share(file_path, self.config['peer']['chunk_size'])
+        algorithm = self.config['peer'].get('hash_algorithm', file_utils.DEFAULT_HASH_ALGORITHM)
+        if not file_utils.is_hash_supported(algorithm):
+            logger.error(f"Cannot share {file_path}: hash algorithm '{algorithm}' is not available")
+            return None
+        meta = self.storage.add_file_to_share(file_path, self.config['peer']['chunk_size'], algorithm)
         if meta: self.register_with_tracker()
         return meta
 
@@ -122,51 +261,144 @@ class Peer:
 
     # --- DOWNLOAD LOGIC ---
 
-    def start_download_thread(self, file_hash: str, destination_path: str = None):
+    def start_download_thread(self, file_hash: str, destination_path: str = None, workers: Optional[int] = None):
         if file_hash in self.active_downloads and self.active_downloads[file_hash]['status'] == 'Downloading':
             return
-        t = threading.Thread(target=self.download_file, args=(file_hash, destination_path), daemon=True)
+        t = threading.Thread(target=self.download_file, args=(file_hash, destination_path, workers), daemon=True)
         t.start()
 
-    def _download_worker(self, q: queue.Queue, f_hash: str, f_meta: dict, peers: list):
+    def _download_worker(self, q: queue.Queue, f_hash: str, f_meta: dict, chunk_digests: List[bytes],
+                         peers: tuple, in_flight: _InFlightChunks):
+        pool = network_utils.chunk_buffer_pool()
+        buf = pool.acquire()
+        try:
+            self._download_chunks(q, f_hash, f_meta, chunk_digests, peers, buf, in_flight)
+            self._hedge_slow_chunks(f_hash, f_meta, chunk_digests, peers, buf, in_flight)
+        finally:
+            pool.release(buf)
+            in_flight.worker_exited()
+
+    def _download_chunks(self, q: queue.Queue, f_hash: str, f_meta: dict, chunk_digests: List[bytes],
+                         peers: tuple, buf: bytearray, in_flight: _InFlightChunks):
+        num_peers = len(peers)
         while True:
+            # Chunks stuck behind a stalled peer come before new work.
+            slow = in_flight.next_slow()
+            if slow:
+                self._hedge_chunk(slow, f_hash, f_meta, chunk_digests, peers, buf, in_flight)
+                continue
+
             try: 
-                idx = q.get(timeout=1)
+                batch = [q.get(timeout=1)]
             except queue.Empty: return
-
-            success = False
-            if not peers: 
-                q.task_done()
-                continue
-                
-            start = idx % len(peers)
-            rotated_peers = peers[start:] + peers[:start]
+            # Take up to pipeline_depth chunks so they can be requested
+            # from one peer without a round trip between them.
+            while len(batch) < self.pipeline_depth:
+                try: batch.append(q.get_nowait())
+                except queue.Empty: break
+
+            # Fast peers get more batches; the rest follow in order as fallbacks.
+            start = self._pick_peer(peers)
+            rotated_peers = (peers[(start + k) % num_peers] for k in range(num_peers))
+            stalled, _ = in_flight.stalled()
+            if stalled:
+                # Try peers that are currently answering first (sort is stable).
+                rotated_peers = sorted(rotated_peers, key=lambda p: p[0] in stalled)
+            pending = batch
 
             for pid, addr in rotated_peers:
-                if pid == self.peer_id: continue
-                try:
-                    data = network_utils.request_chunk_from_peer(addr, f_hash, idx)
-                    if data and file_utils.verify_chunk_data(data, f_meta['chunk_hashes'][idx]):
-                        self.storage.store_chunk(f_hash, idx, data)
-                        self.reputation.update_reputation(pid, "SUCCESSFUL_DOWNLOAD")
-                        self.reputation.update_reputation(pid, "VERIFIED_INTEGRITY")
-                        success = True
-                        break
-                    elif data:
-                        self.reputation.update_reputation(pid, "CORRUPTED_DATA")
-                except: pass
-            
-            if success:
-                if f_hash in self.active_downloads:
-                    self.active_downloads[f_hash]['completed_chunks'] += 1
-                    total = self.active_downloads[f_hash]['total_chunks']
-                    if total > 0:
-                        self.active_downloads[f_hash]['progress'] = (self.active_downloads[f_hash]['completed_chunks'] / total) * 100
-                q.task_done()
+                if not pending: break
+                pending = self._fetch_from_peer(pid, addr, f_hash, f_meta, chunk_digests, pending, buf, in_flight)
+
+            for _ in batch: q.task_done()
+
+    def _pick_peer(self, peers: tuple) -> int:
+        """Index of a peer drawn with weight throughput x reputation."""
+        with self.peer_bandwidth_lock:
+            bandwidth = [self.peer_bandwidth.get(pid) for pid, _ in peers]
+        known = [bw for bw in bandwidth if bw is not None]
+        # Unmeasured peers are assumed as fast as the best one, so each
+        # gets tried early.
+        optimistic = max(known) if known else 1.0
+        weights = [(optimistic if bw is None else bw) * max(self.reputation.get_reputation(pid), 1)
+                   for bw, (pid, _) in zip(bandwidth, peers)]
+        if not any(weights): return random.randrange(len(peers))
+        return random.choices(range(len(peers)), weights=weights)[0]
+
+    def _record_bandwidth(self, pid: str, received: int, elapsed: float):
+        sample = received / max(elapsed, 1e-6)
+        with self.peer_bandwidth_lock:
+            prev = self.peer_bandwidth.get(pid)
+            self.peer_bandwidth[pid] = sample if prev is None else prev + BANDWIDTH_ALPHA * (sample - prev)
+
+    def _hedge_slow_chunks(self, f_hash: str, f_meta: dict, chunk_digests: List[bytes],
+                           peers: tuple, buf: bytearray, in_flight: _InFlightChunks):
+        """Endgame: with the queue drained, keep racing stalled chunks until none are left."""
+        while not in_flight.done.is_set() and in_flight.busy():
+            slow = in_flight.next_slow()
+            if slow is None:
+                in_flight.done.wait(0.1)
+                continue
+            self._hedge_chunk(slow, f_hash, f_meta, chunk_digests, peers, buf, in_flight)
+
+    def _hedge_chunk(self, slow: Tuple[int, str], f_hash: str, f_meta: dict, chunk_digests: List[bytes],
+                     peers: tuple, buf: bytearray, in_flight: _InFlightChunks):
+        """Re-requests a chunk another worker is stuck on from any other peer."""
+        idx, holder = slow
+        for pid, addr in peers:
+            if pid == holder: continue
+            if self.storage.has_chunk(f_hash, idx): return
+            if not self._fetch_from_peer(pid, addr, f_hash, f_meta, chunk_digests, [idx], buf,
+                                         in_flight, hedge=True):
+                return
+
+    def _fetch_from_peer(self, pid: str, addr, f_hash: str, f_meta: dict, chunk_digests: List[bytes],
+                         indices: List[int], buf: bytearray, in_flight: _InFlightChunks,
+                         hedge: bool = False) -> List[int]:
+        """Requests indices from one peer; returns those still not stored."""
+        failed = []
+        received = 0
+
+        # Refusals are answers too: the peer moves on to the next chunk.
+        def on_answer(idx):
+            if not hedge: in_flight.answered(indices, idx)
+
+        def on_chunk(idx, data):
+            nonlocal received
+            on_answer(idx)
+            if file_utils.verify_chunk_data(data, chunk_digests[idx], f_meta['hash_algorithm']):
+                received += len(data)
+                if self.storage.store_chunk(f_hash, idx, data) and in_flight.mark_stored(idx):
+                    self._chunk_completed(f_hash)
+                self.reputation.update_reputation_bulk([(pid, "SUCCESSFUL_DOWNLOAD"),
+                                                        (pid, "VERIFIED_INTEGRITY")])
             else:
-                q.task_done()
+                self.reputation.update_reputation(pid, "CORRUPTED_DATA")
+                failed.append(idx)
 
-    def download_file(self, file_hash: str, destination_path: str = None):
+        # Hedged requests are not tracked, so they are never hedged again.
+        if not hedge: in_flight.start(indices, pid)
+        started = time.perf_counter()
+        try:
+            missing = network_utils.request_chunks_from_peer(addr, f_hash, indices, on_chunk, buf, on_answer)
+        except Exception:
+            missing = indices
+        finally:
+            if not hedge: in_flight.finish(indices)
+        # Failures count as zero throughput, so dead peers lose weight too.
+        self._record_bandwidth(pid, received, time.perf_counter() - started)
+        # A hedged copy may have been stored meanwhile.
+        return [idx for idx in indices
+                if (idx in missing or idx in failed) and idx not in in_flight.stored]
+
+    def _chunk_completed(self, f_hash: str):
+        if f_hash in self.active_downloads:
+            self.active_downloads[f_hash]['completed_chunks'] += 1
+            total = self.active_downloads[f_hash]['total_chunks']
+            if total > 0:
+                self.active_downloads[f_hash]['progress'] = (self.active_downloads[f_hash]['completed_chunks'] / total) * 100
+
+    def download_file(self, file_hash: str, destination_path: str = None, workers: Optional[int] = None):
         if not self.tracker_sock: self.start_tracker_connection()
         try:
             resp = network_utils.query_tracker_for_file(self.tracker_sock, file_hash)
@@ -174,11 +406,24 @@ class Peer:
 
             f_meta = {
                 'name': resp['file_name'], 'size': resp['file_size'],
-                'chunk_hashes': resp['chunk_hashes'], 'chunk_count': resp['chunk_count']
+                'chunk_hashes': resp['chunk_hashes'], 'chunk_count': resp['chunk_count'],
+                'hash_algorithm': resp.get('hash_algorithm', file_utils.DEFAULT_HASH_ALGORITHM),
+                # Chunk size is network-wide config; it places chunks in the .part file.
+                'chunk_size': self.config['peer']['chunk_size']
             }
+            if not file_utils.is_hash_supported(f_meta['hash_algorithm']):
+                logger.error(f"Cannot download {file_hash}: hash algorithm '{f_meta['hash_algorithm']}' is not available")
+                return
+            # The file hash is the Merkle root of the chunk hashes, so once the
+            # list checks out, verified chunks add up to a verified file.
+            if len(f_meta['chunk_hashes']) != f_meta['chunk_count'] or \
+                    file_utils.merkle_root(f_meta['chunk_hashes'], f_meta['hash_algorithm']) != file_hash:
+                logger.error(f"Cannot download {file_hash}: tracker's chunk hashes do not match the file hash")
+                return
             self.storage.add_downloading_file({'hash': file_hash, **f_meta})
             
-            missing = list(self.storage.get_missing_chunks(file_hash))
+            # Head of the file first; set iteration order is not guaranteed.
+            missing = sorted(self.storage.get_missing_chunks(file_hash))
             
             self.active_downloads[file_hash] = {
                 'hash': file_hash,
@@ -208,9 +453,9 @@ class Peer:
                     self._finalize_download(file_hash, out, destination_path)
                     return
 
-                # 3. Do we actually have the chunks to reassemble?
-                if self.storage.has_physical_chunks(file_hash, f_meta['chunk_count']):
-                    if file_utils.reassemble_file(file_hash, f_meta['chunk_count'], self.storage.downloads_dir, out):
+                # 3. Is the finished download still in the downloads folder?
+                if self.storage.has_physical_chunks(file_hash):
+                    if self.storage.complete_download(file_hash, out):
                         self._finalize_download(file_hash, out, destination_path)
                         return
                 
@@ -218,6 +463,7 @@ class Peer:
                 # We must reset and download again.
                 logger.warning(f"Metadata mismatch for {f_meta['name']}. Chunks missing. Restarting download.")
                 # Force 'missing' to be all chunks
+                self.storage.reset_chunks(file_hash)
                 missing = list(range(f_meta['chunk_count']))
                 # --- FIX END ---
 
@@ -225,30 +471,55 @@ class Peer:
             peer_ids = [p['id'] for p in peer_list]
             sorted_ids = self.reputation.get_peers_sorted_by_reputation(peer_ids)
             addr_map = {p['id']: (p['ip'], p['port']) for p in peer_list}
-            sorted_peers = [(pid, addr_map[pid]) for pid, _ in sorted_ids if pid in addr_map]
+            sorted_peers = tuple((pid, addr_map[pid]) for pid, _ in sorted_ids
+                                 if pid in addr_map and pid != self.peer_id)
+            if not sorted_peers:
+                logger.warning(f"No peers are sharing {f_meta['name']}")
+                self.active_downloads[file_hash]['status'] = 'No Peers'
+                return
+
+            # Chunk hashes stay hex in metadata and on the wire; workers
+            # compare raw digests.
+            chunk_digests = [bytes.fromhex(h) for h in f_meta['chunk_hashes']]
 
             q = queue.Queue()
             for i in missing: q.put(i)
 
-            threads = []
-            for _ in range(4):
-                t = threading.Thread(target=self._download_worker, args=(q, file_hash, f_meta, sorted_peers))
+            # More workers than peers only queue up on the same connections.
+            if workers is None:
+                workers = self.config['peer'].get('download_workers', DOWNLOAD_WORKERS)
+            workers = max(1, min(workers, len(sorted_peers)))
+            in_flight = _InFlightChunks(len(missing), workers)
+            for _ in range(workers):
+                # Daemon: a worker stuck on a slow peer may outlive this call
+                # once hedged requests have fetched its chunks elsewhere.
+                t = threading.Thread(target=self._download_worker, daemon=True,
+                                     args=(q, file_hash, f_meta, chunk_digests, sorted_peers, in_flight))
                 t.start()
-                threads.append(t)
             
-            q.join()
-            for t in threads: t.join()
+            # Set once every missing chunk is stored or every worker gave up.
+            # Meanwhile, each worker stuck on a stalled peer gets a stand-in
+            # (up to `workers` extra) so the queue keeps draining.
+            helpers = 0
+            while not in_flight.done.wait(HEDGE_AFTER / 2):
+                _, stuck = in_flight.stalled()
+                while helpers < min(stuck, workers):
+                    in_flight.add_worker()
+                    threading.Thread(target=self._download_worker, daemon=True,
+                                     args=(q, file_hash, f_meta, chunk_digests, sorted_peers, in_flight)).start()
+                    helpers += 1
+            self.storage.flush()
+            self.reputation.flush()
 
             if self.storage.is_download_complete(file_hash):
                 default_out = os.path.join(self.storage.completed_dir, f_meta['name'])
                 
-                # Guard against reassembly crash
-                if self.storage.has_physical_chunks(file_hash, f_meta['chunk_count']):
-                    success = file_utils.reassemble_file(file_hash, f_meta['chunk_count'], self.storage.downloads_dir, default_out)
-                    if success:
+                # Chunks were written in place, so the .part file is the
+                # finished file; it only needs moving.
+                if self.storage.has_physical_chunks(file_hash):
+                    if self.storage.complete_download(file_hash, default_out):
                         self._finalize_download(file_hash, default_out, destination_path)
                     else:
-                        logger.error(f"Reassembly failed for {file_hash}")
                         self.active_downloads[file_hash]['status'] = 'Reassembly Failed'
                 else:
                      self.active_downloads[file_hash]['status'] = 'Missing Chunks'
@@ -288,6 +559,8 @@ class Peer:
                         shutil.copy2(current_path, custom_out)
                         
                     final_path = os.path.abspath(custom_out)
+                    # Keep seeding from wherever the file now lives.
+                    if move: self.storage.update_file_location(file_hash, final_path)
                     logger.info(f"Moved file to: {final_path}")
                 except Exception as e:
                     logger.error(f"Move failed: {e}")
@@ -304,4 +577,8 @@ class Peer:
 
     def stop(self):
         self.is_running = False
+        self.server.close()
+        self.reputation.flush()
+        self.storage.close()
+        network_utils.PEER_CONNECTIONS.close_all()
         if self.tracker_sock: self.tracker_sock.close()
\ No newline at end of file
@@ -2,7 +2,8 @@ import sqlite3
 import logging
 import os
 import threading
-from typing import List, Tuple, Optional, Dict, Any # <-- Added Any here
+import time
+from typing import List, Tuple, Optional, Dict, Any, Set
 
 # --- Configuration ---
 logger = logging.getLogger(__name__)
@@ -19,6 +20,11 @@ REPUTATION_RULES = {
 ALPHA = 0.8
 BETA = 0.2
 DEFAULT_REPUTATION = 10
+# Scores live in memory; changed rows are written back in one transaction
+# once this many events have accumulated or the oldest is this many
+# seconds old, and on flush()/close().
+FLUSH_EVERY = 32
+FLUSH_INTERVAL = 0.5
 
 class ReputationManager:
     def __init__(self, peer_id: str):
@@ -28,6 +34,12 @@ class ReputationManager:
         
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         
+        # peer_id -> (score, interactions); mirrors the table so reads and
+        # sorting never touch SQLite. Writes go through to both.
+        self._cache: Dict[str, Tuple[float, int]] = {}
+        self._dirty: Set[str] = set()
+        self._dirty_events = 0
+        self._dirty_since = 0.0
         self.conn = self._init_db()
         if self.conn is None:
             logger.error("Failed to initialize reputation database.")
@@ -36,6 +48,12 @@ class ReputationManager:
         try:
             conn = sqlite3.connect(self.db_path, check_same_thread=False)
             cursor = conn.cursor()
+            # Scores are soft state: WAL with synchronous=NORMAL skips the
+            # per-commit fsync and can only lose the last few flushes on a
+            # power cut, never corrupt the table.
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA temp_store=MEMORY")
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS reputation (
                     peer_id TEXT PRIMARY KEY,
@@ -44,6 +62,8 @@ class ReputationManager:
                 )
             ''')
             conn.commit()
+            cursor.execute("SELECT peer_id, score, interactions FROM reputation")
+            self._cache = {r[0]: (float(r[1]), int(r[2])) for r in cursor.fetchall()}
             logger.info(f"Reputation database initialized at {self.db_path}")
             return conn
         except sqlite3.Error as e:
@@ -51,98 +71,87 @@ class ReputationManager:
             return None
 
     def get_reputation(self, peer_id: str) -> float:
-        if self.conn is None: return DEFAULT_REPUTATION
-        
         with self.lock:
-            try:
-                cursor = self.conn.cursor()
-                cursor.execute("SELECT score FROM reputation WHERE peer_id = ?", (peer_id,))
-                result = cursor.fetchone()
-                if result:
-                    return float(result[0])
-                return DEFAULT_REPUTATION
-            except sqlite3.Error as e:
-                logger.error(f"Error getting reputation for {peer_id}: {e}")
-                return DEFAULT_REPUTATION
+            cached = self._cache.get(peer_id)
+        return cached[0] if cached else DEFAULT_REPUTATION
 
     def get_all_reputations(self) -> List[Dict[str, Any]]:
         """Returns all peers and their scores for the UI."""
-        if self.conn is None: return []
-        
         with self.lock:
-            try:
-                cursor = self.conn.cursor()
-                cursor.execute("SELECT peer_id, score, interactions FROM reputation ORDER BY score DESC")
-                rows = cursor.fetchall()
-                return [
-                    {"peer_id": r[0], "score": round(r[1], 2), "interactions": r[2]} 
-                    for r in rows
-                ]
-            except sqlite3.Error as e:
-                logger.error(f"Error listing reputations: {e}")
-                return []
+            rows = sorted(self._cache.items(), key=lambda r: r[1][0], reverse=True)
+        return [
+            {"peer_id": peer_id, "score": round(score, 2), "interactions": interactions}
+            for peer_id, (score, interactions) in rows
+        ]
 
     def update_reputation(self, peer_id: str, event_type: str):
-        if self.conn is None: return
-
-        delta_r = REPUTATION_RULES.get(event_type)
-        if delta_r is None:
-            logger.warning(f"Unknown reputation event type: {event_type}")
-            return
+        self.update_reputation_bulk([(peer_id, event_type)])
 
+    def update_reputation_bulk(self, events: List[Tuple[str, str]]):
+        """Records (peer_id, event_type) pairs in order under one lock acquisition."""
         with self.lock:
-            try:
-                cursor = self.conn.cursor()
-                
-                cursor.execute("SELECT score, interactions FROM reputation WHERE peer_id = ?", (peer_id,))
-                result = cursor.fetchone()
-                
-                if result:
-                    old_score, interactions = result
-                    old_score = float(old_score)
-                    interactions = int(interactions)
-                else:
-                    old_score = DEFAULT_REPUTATION
-                    interactions = 0
-                
-                new_score = (ALPHA * old_score) + (BETA * delta_r)
-                
-                cursor.execute('''
-                    INSERT INTO reputation (peer_id, score, interactions)
-                    VALUES (?, ?, ?)
-                    ON CONFLICT(peer_id) DO UPDATE SET
-                        score = excluded.score,
-                        interactions = interactions + 1
-                ''', (peer_id, new_score, interactions + 1))
-                
-                self.conn.commit()
+            for peer_id, event_type in events:
+                delta_r = REPUTATION_RULES.get(event_type)
+                if delta_r is None:
+                    logger.warning(f"Unknown reputation event type: {event_type}")
+                    continue
+                old_score, new_score = self._apply_event(peer_id, delta_r)
+                self._mark_dirty(peer_id)
                 logger.debug(f"Updated reputation for {peer_id}: {old_score:.2f} -> {new_score:.2f} (Event: {event_type})")
-                
-            except sqlite3.Error as e:
-                logger.error(f"Error updating reputation for {peer_id}: {e}")
+            if self._dirty and (self._dirty_events >= FLUSH_EVERY
+                                or time.monotonic() - self._dirty_since >= FLUSH_INTERVAL):
+                self._flush_locked()
 
-    def get_peers_sorted_by_reputation(self, peer_ids: List[str]) -> List[Tuple[str, float]]:
-        if self.conn is None:
-            return [(peer_id, DEFAULT_REPUTATION) for peer_id in peer_ids]
+    def flush(self):
+        """Writes pending score changes to the database."""
+        with self.lock:
+            self._flush_locked()
+
+    def _mark_dirty(self, peer_id: str):
+        if not self._dirty_events:
+            self._dirty_since = time.monotonic()
+        self._dirty.add(peer_id)
+        self._dirty_events += 1
 
+    def _flush_locked(self):
+        """Caller must hold self.lock. Rows stay dirty if the write fails."""
+        if self.conn is None or not self._dirty: return
+        try:
+            self._write_rows(self.conn.cursor(), {peer_id: self._cache[peer_id] for peer_id in self._dirty})
+            self.conn.commit()
+            logger.debug(f"Wrote reputation for {len(self._dirty)} peers")
+            self._dirty.clear()
+            self._dirty_events = 0
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logger.error(f"Error writing reputation updates: {e}")
+
+    def _apply_event(self, peer_id: str, delta_r: int) -> Tuple[float, float]:
+        """Scores one event into the cache. Caller must hold self.lock."""
+        old_score, interactions = self._cache.get(peer_id) or (DEFAULT_REPUTATION, 0)
+        new_score = (ALPHA * old_score) + (BETA * delta_r)
+        self._cache[peer_id] = (new_score, interactions + 1)
+        return old_score, new_score
+
+    @staticmethod
+    def _write_rows(cursor: sqlite3.Cursor, updates: Dict[str, Tuple[float, int]]):
+        cursor.executemany('''
+            INSERT INTO reputation (peer_id, score, interactions)
+            VALUES (?, ?, ?)
+            ON CONFLICT(peer_id) DO UPDATE SET
+                score = excluded.score,
+                interactions = excluded.interactions
+        ''', [(peer_id, score, interactions) for peer_id, (score, interactions) in updates.items()])
+
+    def get_peers_sorted_by_reputation(self, peer_ids: List[str]) -> List[Tuple[str, float]]:
         with self.lock:
-            try:
-                peer_scores = []
-                for peer_id in peer_ids:
-                    cursor = self.conn.cursor()
-                    cursor.execute("SELECT score FROM reputation WHERE peer_id = ?", (peer_id,))
-                    result = cursor.fetchone()
-                    score = float(result[0]) if result else DEFAULT_REPUTATION
-                    peer_scores.append((peer_id, score))
-                
-                peer_scores.sort(key=lambda x: x[1], reverse=True)
-                return peer_scores
-            except Exception as e:
-                logger.error(f"Error sorting peers: {e}")
-                return [(peer_id, DEFAULT_REPUTATION) for peer_id in peer_ids]
+            peer_scores = [(peer_id, self._cache.get(peer_id, (DEFAULT_REPUTATION,))[0]) for peer_id in peer_ids]
+        peer_scores.sort(key=lambda x: x[1], reverse=True)
+        return peer_scores
     
     def close(self):
         with self.lock:
+            self._flush_locked()
             if self.conn:
                 self.conn.close()
                 logger.info("Reputation database connection closed.")
\ No newline at end of file
@@ -2,11 +2,21 @@ import os
 import json
 import logging
 import threading
-from typing import Dict, Any, Set, Optional, List
+from typing import Dict, Any, Set, Optional, List, Tuple, BinaryIO
 from peer import file_utils
+from peer import network_utils
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Chunk progress is written to disk at most this often (seconds) instead
+# of rewriting the whole metadata file for every stored chunk.
+SAVE_DELAY = 0.5
+
 class StorageManager:
     def __init__(self, peer_id: str, instance_dir: str = None):
         self.peer_id = peer_id
@@ -28,18 +38,31 @@ class StorageManager:
         self.file_metadata: Dict[str, Dict[str, Any]] = {}
         self.chunk_tracker: Dict[str, Set[int]] = {}
         self.file_locations: Dict[str, str] = {}
+        # file_hash -> [st_size, st_mtime_ns] of the shared file when it was hashed
+        self.file_stats: Dict[str, List[int]] = {}
+        self._save_timer: Optional[threading.Timer] = None
+        # Shared file path -> fd kept open for sendfile() chunk uploads;
+        # each upload reads from its own dup of it
+        self._fd_cache: Dict[str, int] = {}
+        # Downloading file hash -> fd of its preallocated .part file
+        self._part_fds: Dict[str, int] = {}
+        # Downloading file hash -> chunk writes in progress outside the lock
+        self._part_writers: Dict[str, int] = {}
+        self._writes_done = threading.Condition(self.lock)
         self._load_metadata()
 
     def _load_metadata(self):
         with self.lock:
             try:
                 if os.path.exists(self.metadata_file):
-                    with open(self.metadata_file, 'r') as f:
-                        data = json.load(f)
-                        self.file_metadata = data.get('file_metadata', {})
-                        self.file_locations = data.get('file_locations', {})
-                        chunk_data = data.get('chunk_tracker', {})
-                        self.chunk_tracker = {h: set(c) for h, c in chunk_data.items()}
+                    with open(self.metadata_file, 'rb') as f:
+                        raw = f.read()
+                    data = orjson.loads(raw) if orjson else json.loads(raw)
+                    self.file_metadata = data.get('file_metadata', {})
+                    self.file_locations = data.get('file_locations', {})
+                    self.file_stats = data.get('file_stats', {})
+                    chunk_data = data.get('chunk_tracker', {})
+                    self.chunk_tracker = {h: set(c) for h, c in chunk_data.items()}
                     logger.info(f"Loaded storage metadata from {self.metadata_file}")
                 else:
                     self._save_metadata_internal()
@@ -51,42 +74,142 @@ class StorageManager:
         self.file_metadata = {}
         self.chunk_tracker = {}
         self.file_locations = {}
+        self.file_stats = {}
 
     def _save_metadata(self):
         with self.lock:
             self._save_metadata_internal()
 
+    def _schedule_save(self):
+        """Coalesces frequent metadata writes. Caller must hold self.lock."""
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(SAVE_DELAY, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        """Writes any pending metadata changes to disk."""
+        with self.lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+                self._save_metadata_internal()
+
+    def close(self):
+        """Flushes pending metadata and closes cached file descriptors."""
+        self.flush()
+        with self.lock:
+            while self._part_writers:
+                self._writes_done.wait()
+            for fd in list(self._fd_cache.values()) + list(self._part_fds.values()):
+                try: os.close(fd)
+                except OSError: pass
+            self._fd_cache.clear()
+            self._part_fds.clear()
+
+    def _get_upload_fd(self, file_path: str) -> Optional[int]:
+        """Returns a cached read fd for a shared file. Caller must hold self.lock."""
+        fd = self._fd_cache.get(file_path)
+        if fd is None:
+            try:
+                fd = file_utils.open_for_chunk_reads(file_path)
+            except OSError as e:
+                logger.error(f"Could not open {file_path} for upload: {e}")
+                return None
+            self._fd_cache[file_path] = fd
+        return fd
+
+    def _part_path(self, file_hash: str) -> str:
+        return os.path.join(self.downloads_dir, f"{file_hash}.part")
+
+    def _chunk_size(self, file_hash: str) -> int:
+        """Caller must hold self.lock."""
+        return self.file_metadata[file_hash].get('chunk_size') or network_utils.net_settings().chunk_size
+
+    def _get_part_fd(self, file_hash: str) -> int:
+        """
+        Opens a download's .part file, sized to the whole file on first use
+        so chunks are written straight to their final offsets. If the file
+        has to be created, any chunks recorded for it are forgotten. Caller
+        must hold self.lock.
+        """
+        fd = self._part_fds.get(file_hash)
+        if fd is None:
+            path = self._part_path(file_hash)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                if self.chunk_tracker.get(file_hash):
+                    logger.warning(f"{path} is missing, forgetting its stored chunks")
+                    self.chunk_tracker[file_hash] = set()
+                    self._schedule_save()
+            size = self.file_metadata[file_hash].get('size', 0)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._part_fds[file_hash] = fd
+        return fd
+
     def _save_metadata_internal(self):
         try:
-            with open(self.metadata_file, 'w') as f:
-                chunk_data = {h: list(c) for h, c in self.chunk_tracker.items()}
-                data = {
-                    'file_metadata': self.file_metadata,
-                    'chunk_tracker': chunk_data,
-                    'file_locations': self.file_locations
-                }
-                json.dump(data, f, indent=4)
+            chunk_data = {h: list(c) for h, c in self.chunk_tracker.items()}
+            data = {
+                'file_metadata': self.file_metadata,
+                'chunk_tracker': chunk_data,
+                'file_locations': self.file_locations,
+                'file_stats': self.file_stats
+            }
+            if orjson:
+                with open(self.metadata_file, 'wb') as f:
+                    f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            else:
+                with open(self.metadata_file, 'w') as f:
+                    json.dump(data, f, indent=4)
         except IOError as e:
             logger.error(f"Could not save metadata to {self.metadata_file}: {e}")
 
-    def add_file_to_share(self, file_path: str, chunk_size: int) -> Optional[Dict[str, Any]]:
+    def add_file_to_share(self, file_path: str, chunk_size: int,
+                          hash_algorithm: str = file_utils.DEFAULT_HASH_ALGORITHM) -> Optional[Dict[str, Any]]:
         abs_file_path = os.path.abspath(file_path)
         if not os.path.exists(abs_file_path):
             logger.error(f"File not found: {file_path}")
             return None
+
+        # Stat before hashing: if the file changes mid-hash the recorded
+        # mtime is stale and the next share simply re-hashes.
+        st = os.stat(abs_file_path)
+        signature = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            cached = self._find_cached_share(abs_file_path, signature, chunk_size, hash_algorithm)
+        if cached:
+            logger.info(f"{file_path} is unchanged since it was last shared, reusing its hashes")
+            return cached
             
-        file_meta = file_utils.get_file_metadata(abs_file_path, chunk_size)
+        file_meta = file_utils.get_file_metadata(abs_file_path, chunk_size, hash_algorithm)
         
         if file_meta:
             with self.lock:
                 file_hash = file_meta['hash']
                 self.file_metadata[file_hash] = file_meta
                 self.file_locations[file_hash] = abs_file_path
+                self.file_stats[file_hash] = signature
                 self.chunk_tracker[file_hash] = set(range(file_meta['chunk_count']))
                 self._save_metadata_internal()
             return file_meta
         return None
 
+    def _find_cached_share(self, abs_file_path: str, signature: List[int], chunk_size: int,
+                           hash_algorithm: str) -> Optional[Dict[str, Any]]:
+        """Returns stored metadata for an unchanged shared file. Caller must hold self.lock."""
+        for file_hash, path in self.file_locations.items():
+            if path != abs_file_path or self.file_stats.get(file_hash) != signature:
+                continue
+            meta = self.file_metadata.get(file_hash)
+            if (meta and meta.get('chunk_size') == chunk_size
+                    and meta.get('hash_algorithm', file_utils.DEFAULT_HASH_ALGORITHM) == hash_algorithm):
+                return meta
+        return None
+
     def get_shared_files_info(self) -> List[Dict[str, Any]]:
         with self.lock:
             return list(self.file_metadata.values())
@@ -96,12 +219,49 @@ class StorageManager:
             return self.file_locations.get(file_hash)
 
     # --- NEW: Check if chunks actually exist on disk ---
-    def has_physical_chunks(self, file_hash: str, chunk_count: int) -> bool:
-        """Checks if the actual .0, .1 files exist in the downloads folder."""
-        # Check the first and last chunk as a heuristic, or strictly check all
-        first_chunk = os.path.join(self.downloads_dir, f"{file_hash}.0")
-        last_chunk = os.path.join(self.downloads_dir, f"{file_hash}.{chunk_count-1}")
-        return os.path.exists(first_chunk) and os.path.exists(last_chunk)
+    def has_physical_chunks(self, file_hash: str) -> bool:
+        """Checks that the download's .part file exists and has the full file size."""
+        with self.lock:
+            meta = self.file_metadata.get(file_hash)
+            if meta is None: return False
+            try:
+                return os.path.getsize(self._part_path(file_hash)) == meta.get('size', 0)
+            except OSError:
+                return False
+
+    def reset_chunks(self, file_hash: str):
+        """Forgets the stored chunks of a download whose data is gone."""
+        with self.lock:
+            if file_hash in self.chunk_tracker:
+                self.chunk_tracker[file_hash] = set()
+                self._save_metadata_internal()
+
+    def complete_download(self, file_hash: str, output_path: str) -> bool:
+        """
+        Moves a finished .part file to output_path. The file then serves
+        uploads like any shared file, so no reassembly pass is needed.
+        """
+        with self.lock:
+            while self._part_writers.get(file_hash):
+                self._writes_done.wait()
+            fd = self._part_fds.pop(file_hash, None)
+            if fd is not None: os.close(fd)
+            try:
+                os.replace(self._part_path(file_hash), output_path)
+            except OSError as e:
+                logger.error(f"Could not move download {file_hash} to {output_path}: {e}")
+                return False
+            self.file_locations[file_hash] = os.path.abspath(output_path)
+            self._save_metadata_internal()
+        return True
+
+    def update_file_location(self, file_hash: str, file_path: str):
+        with self.lock:
+            old = self.file_locations.get(file_hash)
+            fd = self._fd_cache.pop(old, None)
+            if fd is not None: os.close(fd)
+            self.file_locations[file_hash] = os.path.abspath(file_path)
+            self._save_metadata_internal()
 
     def add_downloading_file(self, file_meta: Dict[str, Any]):
         with self.lock:
@@ -115,42 +275,71 @@ class StorageManager:
         with self.lock:
             if file_hash not in self.file_metadata:
                 return False
-        
-        chunk_filename = f"{file_hash}.{chunk_index}"
-        chunk_path = os.path.join(self.downloads_dir, chunk_filename)
-        
+            # A re-requested chunk can arrive twice; keep the first copy.
+            if self._has_chunk_internal(file_hash, chunk_index):
+                return True
+            try:
+                fd = self._get_part_fd(file_hash)
+            except OSError as e:
+                logger.error(f"Failed to open the download file of {file_hash}: {e}")
+                return False
+            offset = chunk_index * self._chunk_size(file_hash)
+            # complete_download() waits for registered writers before it
+            # closes the fd, so the write itself can run unlocked.
+            self._part_writers[file_hash] = self._part_writers.get(file_hash, 0) + 1
+
+        ok = False
         try:
-            with open(chunk_path, 'wb') as f:
-                f.write(chunk_data)
-            
+            data_len = len(chunk_data)
+            written = os.pwrite(fd, chunk_data, offset)
+            if written != data_len:
+                raise IOError(f"short write ({written} of {data_len} bytes)")
+            ok = True
+        except (IOError, OSError) as e:
+            logger.error(f"Failed to write chunk {chunk_index} of {file_hash}: {e}")
+        finally:
             with self.lock:
-                self.chunk_tracker[file_hash].add(chunk_index)
-                self._save_metadata_internal()
-            return True
-        except IOError as e:
-            logger.error(f"Failed to write chunk {chunk_path}: {e}")
-            return False
+                self._part_writers[file_hash] -= 1
+                if not self._part_writers[file_hash]:
+                    del self._part_writers[file_hash]
+                    self._writes_done.notify_all()
+                if ok:
+                    self.chunk_tracker[file_hash].add(chunk_index)
+                    self._schedule_save()
+        return ok
 
-    def get_chunk_data_for_upload(self, file_hash: str, chunk_index: int, chunk_size: int) -> Optional[bytes]:
-        original_path = None
+    def open_chunk(self, file_hash: str, chunk_index: int, chunk_size: int) -> Optional[Tuple[BinaryIO, int, int]]:
+        """
+        Locates a chunk on disk for zero-copy upload. Returns (file, offset,
+        length) on a duplicate of the cached fd, owned by the caller, so
+        complete_download(), update_file_location() and close() may close
+        the cached fd mid-upload. None if the chunk is not available.
+        """
         with self.lock:
             if not self._has_chunk_internal(file_hash, chunk_index):
                 return None
-            if file_hash in self.file_locations:
-                original_path = self.file_locations[file_hash]
-
-        if original_path:
-            return file_utils.read_chunk_from_file(original_path, chunk_index, chunk_size)
-        
-        chunk_filename = f"{file_hash}.{chunk_index}"
-        chunk_path = os.path.join(self.downloads_dir, chunk_filename)
-        
-        if os.path.exists(chunk_path):
             try:
-                with open(chunk_path, 'rb') as f:
-                    return f.read()
-            except: return None
-        return None
+                if file_hash in self.file_locations:
+                    fd = self._get_upload_fd(self.file_locations[file_hash])
+                else:
+                    fd = self._get_part_fd(file_hash)
+                # _get_part_fd() forgets the chunks of a recreated .part file.
+                if fd is None or not self._has_chunk_internal(file_hash, chunk_index):
+                    return None
+                fd = os.dup(fd)
+            except OSError:
+                return None
+
+        f = open(fd, 'rb')
+        try:
+            offset = chunk_index * chunk_size
+            length = min(chunk_size, os.fstat(fd).st_size - offset)
+        except OSError:
+            length = 0
+        if length <= 0:
+            f.close()
+            return None
+        return f, offset, length
 
     def has_chunk(self, file_hash: str, chunk_index: int) -> bool:
         with self.lock:
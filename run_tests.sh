@@ -1,6 +1,6 @@
 #!/bin/bash
-echo "Running Peer Utility Tests..."
+echo "Running Peer Utility and Transfer Tests..."
 
 mkdir -p tests
 
-python3 -m unittest -v tests/test_basic_utils.py
\ No newline at end of file
+python3 -m unittest -v tests/test_basic_utils.py tests/test_basic_transfer.py
\ No newline at end of file
@@ -3,4 +3,4 @@ echo "Starting Tracker Server..."
 
 mkdir -p tracker
 
-python3 tracker/tracker.py
\ No newline at end of file
+python3 -m tracker.tracker
\ No newline at end of file
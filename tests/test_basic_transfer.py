@@ -1 +1,273 @@
- 
+import unittest
+import os
+import sys
+import socket
+import struct
+import threading
+import tempfile
+import shutil
+import hashlib
+import queue
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from peer import network_utils
+from peer import peer as peer_module
+
+class TestWireFraming(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.b.settimeout(5.0)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_01_message_round_trip(self):
+        print("\nTesting network_utils: framed message round trip...")
+        msg = {"command": "search", "payload": {"query": "héllo"}}
+        network_utils.send_message(self.a, msg)
+        network_utils.send_message(self.a, {"status": "success"})
+        self.assertEqual(network_utils.receive_json_message(self.b, 4096), msg)
+        self.assertEqual(network_utils.receive_json_message(self.b, 4096), {"status": "success"})
+
+    def test_02_small_reads(self):
+        print("\nTesting network_utils: message split across many recvs...")
+        msg = {"status": "success", "results": [{"name": "x" * 100}]}
+        network_utils.send_message(self.a, msg)
+        self.assertEqual(network_utils.receive_json_message(self.b, 3), msg)
+
+    def test_03_eof_and_oversized(self):
+        print("\nTesting network_utils: truncated and oversized frames...")
+        self.a.sendall(struct.pack('!I', network_utils.MAX_MESSAGE_SIZE + 1))
+        self.assertIsNone(network_utils.receive_json_message(self.b, 4096))
+
+        self.a.sendall(struct.pack('!I', 10) + b'{"a"')
+        self.a.shutdown(socket.SHUT_WR)
+        self.assertIsNone(network_utils.receive_json_message(self.b, 4096))
+
+    def test_04_chunk_from_file(self):
+        print("\nTesting network_utils: binary chunk header followed by sendfile payload...")
+        payload = os.urandom(200000)
+        with tempfile.TemporaryFile() as f:
+            f.write(payload)
+            f.flush()
+            t = threading.Thread(target=network_utils._send_chunk_file, args=(self.a, f, 5000, 1000))
+            t.start()
+            header = network_utils._recv_exact(self.b, network_utils._CHUNK_HDR.size, 4096)
+            self.assertEqual(network_utils._CHUNK_HDR.unpack(header), (network_utils.CHUNK_OK, 1000))
+            self.assertEqual(network_utils._recv_exact(self.b, 1000, 65536), payload[5000:6000])
+            t.join()
+
+    def test_05_keep_alive_handler(self):
+        print("\nTesting network_utils: several chunk requests on one connection...")
+        payload = os.urandom(3000)
+
+        class Storage:
+            def open_chunk(self, file_hash, chunk_index, chunk_size):
+                if chunk_index > 2: return None
+                f = tempfile.TemporaryFile()
+                f.write(payload)
+                f.flush()
+                return f, chunk_index * 1000, 1000
+
+        server = network_utils.PeerServer(Storage(), max_workers=1)
+        listener = socket.create_server(('127.0.0.1', 0))
+        t = threading.Thread(target=server.serve_forever, args=(listener,))
+        t.start()
+        try:
+            self.a.close()
+            self.a = socket.create_connection(listener.getsockname())
+            self.a.settimeout(5.0)
+            for idx in (2, 5, 0):
+                request = network_utils._CHUNK_REQ.pack(network_utils.OP_REQUEST_CHUNK, bytes(32), idx)
+                self.a.sendall(request)
+                data = network_utils._read_chunk_response(self.a, None, 4096)
+                if idx > 2:
+                    self.assertIsNone(data)
+                else:
+                    self.assertEqual(data, payload[idx * 1000:(idx + 1) * 1000])
+        finally:
+            server.close()
+            t.join(5)
+            listener.close()
+        self.assertFalse(t.is_alive())
+
+class TestPeerServer(unittest.TestCase):
+
+    def test_01_serves_keep_alive_connections(self):
+        print("\nTesting network_utils: PeerServer serves pooled keep-alive connections...")
+        payload = os.urandom(4000)
+
+        class Storage:
+            def open_chunk(self, file_hash, chunk_index, chunk_size):
+                f = tempfile.TemporaryFile()
+                f.write(payload)
+                f.flush()
+                return f, chunk_index * 1000, 1000
+
+        server = network_utils.PeerServer(Storage(), max_workers=2)
+        listener = socket.create_server(('127.0.0.1', 0))
+        t = threading.Thread(target=server.serve_forever, args=(listener,))
+        t.start()
+        try:
+            clients = [socket.create_connection(listener.getsockname()) for _ in range(3)]
+            for idx in (3, 1, 0, 2):
+                for c in clients:
+                    c.settimeout(5.0)
+                    request = network_utils._CHUNK_REQ.pack(network_utils.OP_REQUEST_CHUNK, bytes(32), idx)
+                    c.sendall(request)
+                    data = network_utils._read_chunk_response(c, None, 4096)
+                    self.assertEqual(data, payload[idx * 1000:(idx + 1) * 1000])
+            for c in clients:
+                c.close()
+        finally:
+            server.close()
+            t.join(5)
+            listener.close()
+        self.assertFalse(t.is_alive())
+
+    def test_02_pipelined_requests(self):
+        print("\nTesting network_utils: pipelined chunk requests on one connection...")
+        payload = os.urandom(4000)
+
+        class Storage:
+            def open_chunk(self, file_hash, chunk_index, chunk_size):
+                if chunk_index > 3: return None
+                f = tempfile.TemporaryFile()
+                f.write(payload)
+                f.flush()
+                return f, chunk_index * 1000, 1000
+
+        server = network_utils.PeerServer(Storage(), max_workers=2)
+        listener = socket.create_server(('127.0.0.1', 0))
+        t = threading.Thread(target=server.serve_forever, args=(listener,))
+        t.start()
+        try:
+            got = {}
+            buf = bytearray(1000)
+            missing = network_utils.request_chunks_from_peer(
+                listener.getsockname(), "00" * 32, [3, 5, 0, 2],
+                lambda idx, data: got.__setitem__(idx, bytes(data)), buf)
+            self.assertEqual(missing, [5])
+            self.assertEqual(sorted(got), [0, 2, 3])
+            for idx, data in got.items():
+                self.assertEqual(data, payload[idx * 1000:(idx + 1) * 1000])
+        finally:
+            network_utils.PEER_CONNECTIONS.close_all()
+            server.close()
+            t.join(5)
+            listener.close()
+
+class TestBufferPool(unittest.TestCase):
+
+    def test_01_reuse(self):
+        print("\nTesting network_utils: BufferPool reuses released buffers...")
+        pool = network_utils.BufferPool(16, capacity=1)
+        buf = pool.acquire()
+        self.assertEqual(len(buf), 16)
+        pool.release(buf)
+        self.assertIs(pool.acquire(), buf)
+        # Wrong-sized buffers and overflow beyond capacity are dropped.
+        pool.release(bytearray(8))
+        self.assertEqual(len(pool.acquire()), 16)
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        # config.yaml is read relative to the working directory, once.
+        network_utils.net_settings()
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        self.hedge_after = peer_module.HEDGE_AFTER
+        peer_module.HEDGE_AFTER = 0.3
+
+    def tearDown(self):
+        peer_module.HEDGE_AFTER = self.hedge_after
+        network_utils.PEER_CONNECTIONS.close_all()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _download(self, refuse, bandwidth=None):
+        """
+        Downloads 12 chunks with two workers from two slow but live peers:
+        the first worker pipelines ten of them, the second takes the other
+        two and, once idle, races any chunk it finds stuck. refuse(peer_index,
+        chunk_index) picks the chunks a peer answers "Not found". Returns
+        the indices served, one entry per upload.
+        """
+        size, chunk_count = 1000, 12
+        payload = os.urandom(size * chunk_count)
+        served = []
+
+        class SlowStorage:
+            # Each chunk takes half of HEDGE_AFTER; a pipelined batch
+            # takes longer than it.
+            def __init__(self, n):
+                self.n = n
+
+            def open_chunk(self, file_hash, chunk_index, chunk_size):
+                if refuse(self.n, chunk_index): return None
+                served.append(chunk_index)
+                time.sleep(0.15)
+                f = tempfile.TemporaryFile()
+                f.write(payload)
+                f.flush()
+                return f, chunk_index * size, size
+
+        servers, peers = [], []
+        for n in range(2):
+            server = network_utils.PeerServer(SlowStorage(n), max_workers=2)
+            listener = socket.create_server(('127.0.0.1', 0))
+            t = threading.Thread(target=server.serve_forever, args=(listener,))
+            t.start()
+            servers.append((server, t, listener))
+            peers.append((f"seed{n}", listener.getsockname()))
+
+        leech = peer_module.Peer(instance_name="leech")
+        leech.pipeline_depth = 10
+        leech.peer_bandwidth.update(bandwidth or {})
+        chunks = [payload[i * size:(i + 1) * size] for i in range(chunk_count)]
+        f_hash = hashlib.sha256(payload).hexdigest()
+        f_meta = {'name': 'slow.dat', 'size': len(payload), 'chunk_count': chunk_count,
+                  'chunk_hashes': [hashlib.sha256(c).hexdigest() for c in chunks],
+                  'hash_algorithm': 'sha256', 'chunk_size': size}
+        leech.storage.add_downloading_file({'hash': f_hash, **f_meta})
+        digests = [bytes.fromhex(h) for h in f_meta['chunk_hashes']]
+        q = queue.Queue()
+        for i in range(chunk_count): q.put(i)
+        in_flight = peer_module._InFlightChunks(chunk_count, 2)
+        workers = [threading.Thread(target=leech._download_worker,
+                                    args=(q, f_hash, f_meta, digests, tuple(peers), in_flight))
+                   for _ in range(2)]
+        try:
+            for w in workers: w.start()
+            self.assertTrue(in_flight.done.wait(10))
+            for w in workers: w.join(5)
+            self.assertTrue(leech.storage.is_download_complete(f_hash))
+        finally:
+            leech.storage.close()
+            leech.reputation.close()
+            for server, t, listener in servers:
+                server.close()
+                t.join(5)
+                listener.close()
+        return sorted(served)
+
+    def test_01_slow_live_peer_not_hedged(self):
+        print("\nTesting peer: pipelined chunks from a slow but live peer are not re-requested...")
+        self.assertEqual(self._download(lambda n, idx: False), list(range(12)))
+
+    def test_02_refused_chunk_restarts_batch_clock(self):
+        print("\nTesting peer: a refused chunk does not get the rest of its batch re-requested...")
+        # seed0 gets both batches and refuses chunk 0; seed1 only serves it.
+        served = self._download(lambda n, idx: n == 0 and idx == 0,
+                                bandwidth={"seed0": 1e12, "seed1": 1.0})
+        self.assertEqual(served, list(range(12)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,13 @@ import os
 import shutil
 import sys
 import sqlite3
+from unittest import mock
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
 from peer import file_utils
+from peer import network_utils
 from peer.storage import StorageManager
 from peer.reputation import ReputationManager
 
@@ -31,7 +33,7 @@ class TestPeerUtils(unittest.TestCase):
             f.write(b"C" * 512)
         
         self.dummy_file_size = os.path.getsize(self.dummy_file_path)
-        self.dummy_file_hash = file_utils.get_file_hash(self.dummy_file_path)
+        self.dummy_file_hash = file_utils.get_file_hash(self.dummy_file_path, self.chunk_size)
 
     def tearDown(self):
         """Clean up all created files and directories after each test."""
@@ -46,8 +48,14 @@ class TestPeerUtils(unittest.TestCase):
         self.assertIsNotNone(self.dummy_file_hash)
         self.assertEqual(len(self.dummy_file_hash), 64)
 
-    def test_02_file_splitting_and_reassembly(self):
-        print("\nTesting file_utils: Splitting and Reassembly...")
+        # Without a chunk size the configured peer.chunk_size is used.
+        default_hash = file_utils.get_file_hash(self.dummy_file_path)
+        self.assertEqual(default_hash, file_utils.get_file_hash(
+            self.dummy_file_path, network_utils.net_settings().chunk_size))
+        self.assertTrue(file_utils.verify_file_integrity(self.dummy_file_path, default_hash))
+
+    def test_02_file_splitting(self):
+        print("\nTesting file_utils: Splitting...")
         output_chunk_dir = os.path.join(self.test_dir, "split_chunks")
         meta = file_utils.split_file(self.dummy_file_path, self.chunk_size, output_chunk_dir)
         
@@ -58,13 +66,28 @@ class TestPeerUtils(unittest.TestCase):
         self.assertEqual(meta['chunk_count'], 3)
         self.assertEqual(len(meta['chunk_hashes']), 3)
 
-        reassembled_path = os.path.join(self.test_dir, "reassembled_file.txt")
-        success = file_utils.reassemble_file(meta['hash'], meta['chunk_count'], output_chunk_dir, reassembled_path)
-        self.assertTrue(success)
+        first_digest = bytes.fromhex(meta['chunk_hashes'][0])
+        self.assertTrue(file_utils.verify_chunk_data(b"A" * self.chunk_size, first_digest))
+        self.assertFalse(file_utils.verify_chunk_data(b"B" * self.chunk_size, first_digest))
+
+        for i in range(meta['chunk_count']):
+            chunk_path = os.path.join(output_chunk_dir, f"{meta['hash']}.{i}")
+            with open(chunk_path, 'rb') as f:
+                self.assertTrue(file_utils.verify_chunk_data(f.read(), bytes.fromhex(meta['chunk_hashes'][i])))
+
+    def test_02b_merkle_root(self):
+        print("\nTesting file_utils: Merkle root file hash...")
+        meta = file_utils.get_file_metadata(self.dummy_file_path, self.chunk_size)
+        self.assertEqual(meta['hash'], file_utils.merkle_root(meta['chunk_hashes']))
+        self.assertEqual(meta['hash'], self.dummy_file_hash)
+
+        # Any change to a chunk hash, or to their order, changes the root.
+        tampered = list(meta['chunk_hashes'])
+        tampered[0], tampered[1] = tampered[1], tampered[0]
+        self.assertNotEqual(file_utils.merkle_root(tampered), meta['hash'])
 
-        reassembled_hash = file_utils.get_file_hash(reassembled_path)
-        self.assertEqual(self.dummy_file_hash, reassembled_hash)
-        self.assertTrue(file_utils.verify_file_integrity(reassembled_path, self.dummy_file_hash))
+        # A single leaf is still wrapped, so it never equals the raw chunk hash.
+        self.assertNotEqual(file_utils.merkle_root(meta['chunk_hashes'][:1]), meta['chunk_hashes'][0])
 
     
     def test_03_storage_manager_init(self):
@@ -98,6 +121,54 @@ class TestPeerUtils(unittest.TestCase):
         self.assertEqual(len(shared_files), 1)
         self.assertEqual(shared_files[0]['hash'], self.dummy_file_hash)
 
+    def test_04a_storage_reshare_uses_cached_hashes(self):
+        print("\nTesting storage: Re-sharing an unchanged file skips hashing...")
+        storage = StorageManager(self.peer_id)
+        meta = storage.add_file_to_share(self.dummy_file_path, self.chunk_size)
+        storage.close()
+
+        # The cache survives a restart; only a changed size or mtime re-hashes.
+        storage = StorageManager(self.peer_id)
+        with mock.patch.object(file_utils, 'get_file_metadata', wraps=file_utils.get_file_metadata) as hashed:
+            self.assertEqual(storage.add_file_to_share(self.dummy_file_path, self.chunk_size), meta)
+            self.assertEqual(hashed.call_count, 0)
+
+            st = os.stat(self.dummy_file_path)
+            os.utime(self.dummy_file_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertEqual(storage.add_file_to_share(self.dummy_file_path, self.chunk_size), meta)
+            self.assertEqual(hashed.call_count, 1)
+
+            with open(self.dummy_file_path, "ab") as f:
+                f.write(b"D")
+            os.utime(self.dummy_file_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            changed = storage.add_file_to_share(self.dummy_file_path, self.chunk_size)
+            self.assertEqual(hashed.call_count, 2)
+            self.assertEqual(changed['size'], self.dummy_file_size + 1)
+            self.assertNotEqual(changed['hash'], meta['hash'])
+        storage.close()
+
+    def test_04b_storage_upload_outlives_cached_fd(self):
+        print("\nTesting storage: Uploads keep their file after the cached fd closes...")
+        storage = StorageManager(self.peer_id)
+        storage.add_file_to_share(self.dummy_file_path, self.chunk_size)
+        with open(self.dummy_file_path, "rb") as f:
+            expected = f.read()[self.chunk_size:2 * self.chunk_size]
+
+        moved = storage.open_chunk(self.dummy_file_hash, 1, self.chunk_size)
+        moved_path = os.path.join(self.test_dir, "moved.txt")
+        shutil.copy(self.dummy_file_path, moved_path)
+        storage.update_file_location(self.dummy_file_hash, moved_path)
+        stopped = storage.open_chunk(self.dummy_file_hash, 1, self.chunk_size)
+        storage.close()
+
+        unrelated = os.path.join(self.test_dir, "unrelated.txt")
+        with open(unrelated, "wb") as f:
+            f.write(b"S" * self.dummy_file_size)
+        with open(unrelated, "rb"):
+            for upload, offset, length in (moved, stopped):
+                with upload:
+                    self.assertEqual(os.pread(upload.fileno(), length, offset), expected)
+
     def test_05_storage_download_tracking(self):
         print("\nTesting storage: Download tracking...")
         storage = StorageManager(self.peer_id)
@@ -122,6 +193,63 @@ class TestPeerUtils(unittest.TestCase):
         missing = storage.get_missing_chunks(file_meta['hash'])
         self.assertEqual(missing, {0, 1, 3, 4})
 
+    def test_05b_storage_download_in_place(self):
+        print("\nTesting storage: In-place chunk writes...")
+        storage = StorageManager(self.peer_id)
+        file_meta = {
+            "name": "in_place.dat",
+            "size": self.dummy_file_size,
+            "hash": self.dummy_file_hash,
+            "chunk_count": 3,
+            "chunk_size": self.chunk_size
+        }
+        storage.add_downloading_file(file_meta)
+        
+        with open(self.dummy_file_path, "rb") as f:
+            data = f.read()
+        # Out of order, as concurrent workers would deliver them
+        for idx in (2, 0, 1):
+            chunk = data[idx * self.chunk_size:(idx + 1) * self.chunk_size]
+            self.assertTrue(storage.store_chunk(file_meta['hash'], idx, chunk))
+        self.assertTrue(storage.is_download_complete(file_meta['hash']))
+        self.assertTrue(storage.has_physical_chunks(file_meta['hash']))
+        
+        # An upload still in flight keeps reading the same file after the
+        # download completes and its cached fd is closed.
+        upload, offset, length = storage.open_chunk(file_meta['hash'], 1, self.chunk_size)
+        out = os.path.join(self.test_dir, "in_place_out.dat")
+        self.assertTrue(storage.complete_download(file_meta['hash'], out))
+        unrelated = os.path.join(self.test_dir, "unrelated.dat")
+        with open(unrelated, "wb") as f:
+            f.write(b"S" * len(data))
+        with open(unrelated, "rb"), upload:
+            self.assertEqual(os.pread(upload.fileno(), length, offset),
+                             data[self.chunk_size:2 * self.chunk_size])
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(storage.get_original_file_path(file_meta['hash']), os.path.abspath(out))
+        storage.close()
+
+    def test_05c_storage_lost_part_file(self):
+        print("\nTesting storage: Deleted .part file resets stored chunks...")
+        file_meta = {
+            "name": "lost.dat",
+            "size": self.dummy_file_size,
+            "hash": self.dummy_file_hash,
+            "chunk_count": 3,
+            "chunk_size": self.chunk_size
+        }
+        storage = StorageManager(self.peer_id)
+        storage.add_downloading_file(file_meta)
+        self.assertTrue(storage.store_chunk(file_meta['hash'], 0, b"A" * self.chunk_size))
+        storage.close()
+        os.remove(storage._part_path(file_meta['hash']))
+
+        storage = StorageManager(self.peer_id)
+        self.assertFalse(storage.has_physical_chunks(file_meta['hash']))
+        self.assertIsNone(storage.open_chunk(file_meta['hash'], 0, self.chunk_size))
+        self.assertEqual(storage.get_missing_chunks(file_meta['hash']), {0, 1, 2})
+        storage.close()
 
     def test_06_reputation_manager_init(self):
         print("\nTesting reputation: Initialization...")
@@ -188,5 +316,42 @@ class TestPeerUtils(unittest.TestCase):
         
         rep_manager.close()
 
+    def test_09_reputation_batch(self):
+        print("\nTesting reputation: Batched updates...")
+        rep_manager = ReputationManager(self.peer_id)
+        
+        # Same scores as applying the events one by one, in order
+        # R = (0.8 * 10) + (0.2 * 3) = 8.6, then (0.8 * 8.6) + (0.2 * 3) = 7.48
+        rep_manager.update_reputation_bulk([("peer_a", "SUCCESSFUL_DOWNLOAD"),
+                                            ("peer_b", "CORRUPTED_DATA"),
+                                            ("peer_a", "SUCCESSFUL_DOWNLOAD")])
+        self.assertAlmostEqual(rep_manager.get_reputation("peer_a"), 7.48)
+        self.assertAlmostEqual(rep_manager.get_reputation("peer_b"), 7.0)
+
+        # Interleaved events score differently from the same events grouped
+        # R = 0.8 * ((0.8 * 10) + (0.2 * 3)) + (0.2 * -5) = 5.88
+        rep_manager.update_reputation_bulk([("peer_c", "SUCCESSFUL_DOWNLOAD"),
+                                            ("peer_c", "CORRUPTED_DATA")])
+        self.assertAlmostEqual(rep_manager.get_reputation("peer_c"), 5.88)
+        
+        interactions = {r['peer_id']: r['interactions'] for r in rep_manager.get_all_reputations()}
+        self.assertEqual(interactions, {"peer_a": 2, "peer_b": 1, "peer_c": 2})
+        
+        rep_manager.close()
+
+    def test_10_reputation_write_behind(self):
+        print("\nTesting reputation: Write-behind cache...")
+        rep_manager = ReputationManager(self.peer_id)
+        rep_manager.update_reputation("peer_c", "SUCCESSFUL_UPLOAD")
+        
+        # Visible right away, written to SQLite on flush
+        self.assertAlmostEqual(rep_manager.get_reputation("peer_c"), 8.6)
+        rep_manager.flush()
+        
+        reopened = ReputationManager(self.peer_id)
+        self.assertAlmostEqual(reopened.get_reputation("peer_c"), 8.6)
+        reopened.close()
+        rep_manager.close()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
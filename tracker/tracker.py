@@ -1,21 +1,20 @@
 import socket
 import threading
-import json
-import yaml
 import logging
-from typing import Dict, Any, List, Tuple, Optional
+from typing import Dict, Any, List, Tuple
 
-# --- Configuration ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - [Tracker] - %(levelname)s - %(message)s')
+# The tracker speaks the same wire format as the peers, so it shares their
+# config loader and message helpers instead of keeping its own copies.
+from peer import network_utils
 
-CONFIG_FILE = 'config.yaml'
+# --- Configuration ---
+logger = logging.getLogger(__name__)
 
 def load_config():
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            return yaml.safe_load(f)
+        return network_utils.load_config()
     except Exception as e:
-        logging.error(f"Error loading config: {e}")
+        logger.error(f"Error loading config: {e}")
         exit(1)
 
 # --- Global State ---
@@ -26,21 +25,6 @@ peer_registry: Dict[str, Tuple[str, int]] = {}
 index_lock = threading.Lock()
 peer_lock = threading.Lock()
 
-# --- Receive Helper ---
-def receive_json_message(conn: socket.socket, buffer_size: int) -> Optional[Dict[str, Any]]:
-    buffer = b""
-    json_decoder = json.JSONDecoder()
-    while True:
-        try:
-            message, index = json_decoder.raw_decode(buffer.decode('utf-8'))
-            return message
-        except json.JSONDecodeError:
-            data = conn.recv(buffer_size)
-            if not data: return None
-            buffer += data
-        except Exception:
-            return None
-
 # --- Tracker Logic ---
 
 def handle_register(payload: Dict[str, Any], client_ip: str) -> Dict[str, Any]:
@@ -51,7 +35,7 @@ def handle_register(payload: Dict[str, Any], client_ip: str) -> Dict[str, Any]:
         
         with peer_lock:
             peer_registry[peer_id] = (client_ip, peer_port)
-            logging.info(f"Registered peer {peer_id} at {client_ip}:{peer_port}")
+            logger.info(f"Registered peer {peer_id} at {client_ip}:{peer_port}")
 
         with index_lock:
             for file_info in files:
@@ -62,6 +46,7 @@ def handle_register(payload: Dict[str, Any], client_ip: str) -> Dict[str, Any]:
                         "size": file_info['size'],
                         "chunk_count": file_info['chunk_count'],
                         "chunk_hashes": file_info['chunk_hashes'],
+                        "hash_algorithm": file_info.get('hash_algorithm', 'sha256'),
                         "peers": set()
                     }
                 file_index[file_hash]["peers"].add(peer_id)
@@ -92,6 +77,7 @@ def handle_query_file(payload: Dict[str, Any]) -> Dict[str, Any]:
                 "file_size": file_info["size"],
                 "chunk_count": file_info["chunk_count"],
                 "chunk_hashes": file_info["chunk_hashes"],
+                "hash_algorithm": file_info["hash_algorithm"],
                 "peers": found_peers
             }
     except Exception as e:
@@ -129,17 +115,18 @@ def handle_deregister(peer_id: str):
                     to_prune.append(fh)
             for fh in to_prune:
                 del file_index[fh]
-        logging.info(f"Deregistered {peer_id}")
+        logger.info(f"Deregistered {peer_id}")
     except Exception:
         pass
 
-def handle_client(conn: socket.socket, addr: Tuple[str, int]):
-    logging.info(f"New connection from {addr}")
-    config = load_config()
+def handle_client(conn: socket.socket, addr: Tuple[str, int], buffer_size: int):
+    logger.info(f"New connection from {addr}")
     peer_id = None
     try:
+        # Replies are single small frames; don't let Nagle hold them back.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         while True:
-            message = receive_json_message(conn, config['tracker']['buffer_size'])
+            message = network_utils.receive_json_message(conn, buffer_size)
             if not message: break
             
             command = message.get('command')
@@ -155,9 +142,9 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]):
             else:
                 resp = {"status": "error", "message": "Unknown command"}
             
-            conn.sendall(json.dumps(resp).encode('utf-8'))
+            network_utils.send_message(conn, resp)
     except Exception as e:
-        logging.warning(f"Client error: {e}")
+        logger.warning(f"Client error: {e}")
     finally:
         if peer_id: handle_deregister(peer_id)
         conn.close()
@@ -166,15 +153,17 @@ def main():
     config = load_config()
     host = config['tracker']['host']
     port = config['tracker']['port']
+    buffer_size = config['tracker']['buffer_size']
     
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
         s.listen(5)
-        logging.info(f"Tracker listening on {host}:{port}")
+        logger.info(f"Tracker listening on {host}:{port}")
         while True:
             conn, addr = s.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+            threading.Thread(target=handle_client, args=(conn, addr, buffer_size), daemon=True).start()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - [Tracker] - %(levelname)s - %(message)s')
     main()
\ No newline at end of file